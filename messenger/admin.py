@@ -2,16 +2,89 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User, Group as UserGroup
 from django.contrib.sites.models import Site
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 
 from .models import Profile, Chat, Message, Group, DocumentTemplate
 from .forms import CustomUserCreationForm
 
 
+class EstimatedCountPaginator(Paginator):
+    """Avoids exact `COUNT(*)` over large tables in changelists.
+
+    Unfiltered PostgreSQL tables use the planner's row estimate, anything else is counted up to `count_limit` rows,
+    so a changelist never scans more than that.
+    """
+
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.estimate_rows(queryset)
+            if estimate is not None and estimate > self.count_limit:
+                return estimate
+        return queryset[:self.count_limit].count()
+
+    @staticmethod
+    def estimate_rows(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] > 0 else None
+
+
+class RelatedIdFilter(admin.SimpleListFilter):
+    """Filters by the id of a related object typed into an input, instead of listing every object in the sidebar."""
+
+    template = 'admin/messenger/input_filter.html'
+    field_name = None
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value and value.isdigit():
+            return queryset.filter(**{f'{self.field_name}_id': value})
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value(),
+            'parameter_name': self.parameter_name,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'hidden_params': [(name, value) for name, value in changelist.params.items()
+                              if name not in (self.parameter_name, 'p')],
+        }
+
+
+class ChatIdFilter(RelatedIdFilter):
+    title = 'чатом'
+    parameter_name = 'chat'
+    field_name = 'chat'
+
+
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'email')
-    search_fields = ('user__username',)
+    list_select_related = ('user',)
+    # A prefix match has no leading wildcard, so on PostgreSQL the UPPER(username) pattern index from migration 0010
+    # can narrow the scan, unlike the default substring search. Users are only found by the start of their username.
+    search_fields = ('^user__username',)
+    autocomplete_fields = ('user', 'group')
     exclude = ('bio', 'email_confirmed',)
+    readonly_fields = ('email_digest_sent_at',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class ProfileInline(admin.StackedInline):
@@ -20,6 +93,7 @@ class ProfileInline(admin.StackedInline):
     verbose_name_plural = 'Профілі'
 
     exclude = ('bio', 'email_confirmed',)
+    readonly_fields = ('email_digest_sent_at',)
 
 
 class UserAdminCustom(UserAdmin):
@@ -35,12 +109,24 @@ class UserAdminCustom(UserAdmin):
 
 class ChatAdmin(admin.ModelAdmin):
     list_display = ('id', 'name')
+    ordering = ('-id',)
+    list_filter = ('type',)
+    # Served by the UPPER(name) pattern index on PostgreSQL, see ProfileAdmin.search_fields
+    search_fields = ('^name',)
+    autocomplete_fields = ('users', 'creator', 'group')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('number', 'chat', 'user', 'text', 'timestamp')
-
-    list_filter = ('chat', )
+    list_select_related = ('chat', 'user')
+    list_filter = (ChatIdFilter, )
+    # Prefix search by author, see ProfileAdmin.search_fields
+    search_fields = ('^user__username',)
+    autocomplete_fields = ('chat', 'user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class GroupAdmin(admin.ModelAdmin):
@@ -1,34 +1,41 @@
+import math
 from io import BytesIO
 
-import requests
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.http import FileResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, StreamingHttpResponse
 from django.shortcuts import redirect
-from django.contrib.auth import login, logout
+from django.contrib.auth import authenticate, login, logout
+from django.db.models import OuterRef, Prefetch, Q, Subquery
+from django.db.models.fields.files import FieldFile
 from rest_framework import viewsets
 from rest_framework import filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import serializers
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.decorators import authentication_classes, permission_classes
-from docxtpl import DocxTemplate
 
+from . import oauth
 from . import serializers as msg_serializers
-from .models import Chat, Message, Group, Profile, User, DocumentTemplate
+from .archive import MessageHistory
+from .authentication import create_token_pair, create_ws_ticket, decode_token
+from .broadcast import broadcast_message
+from .conditional import bump_chat_versions, conditional
+from .export import EXPORT_FORMATS, export_chat_history, stream_async
+from .models import Chat, Message, Group, User, DocumentTemplate
+from .ratelimit import Overloaded, check_message_rate, write_admission
+from .snapshot import get_pinned_messages
+from .thumbnails import ThumbnailError, ThumbnailUnavailable, get_thumbnail_cache
 from msg.settings import BASE_FRONTEND_URL
 
 
 @authentication_classes([])
 @permission_classes([])
 class GoogleLoginApi(APIView):
-    GOOGLE_ID_TOKEN_INFO_URL = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
-    GOOGLE_ACCESS_TOKEN_OBTAIN_URL = 'https://oauth2.googleapis.com/token'
-    GOOGLE_USER_INFO_URL = 'https://www.googleapis.com/oauth2/v3/userinfo'
-
     class InputSerializer(serializers.Serializer):
         code = serializers.CharField(required=False)
         error = serializers.CharField(required=False)
@@ -43,11 +50,14 @@ class GoogleLoginApi(APIView):
 
         if error or not code:
             return redirect(login_url)
-        redirect_uri = f'http://localhost:8000/accounts/google/login/callback/'
-
-        access_token = self.google_get_access_token(code=code, redirect_uri=redirect_uri)
+        redirect_uri = f'{settings.BASE_BACKEND_URL}/accounts/google/login/callback/'
 
-        user_data = self.google_get_user_info(access_token=access_token)
+        # The user is read from the signed ID token of the token response, no userinfo request is needed
+        try:
+            tokens = oauth.exchange_code(code, redirect_uri)
+            user_data = oauth.verify_id_token(tokens['id_token'])
+        except (oauth.OAuthError, KeyError, ValueError):
+            raise ValidationError('Failed to obtain user info from Google.')
 
         profile_data = {
             'email': user_data['email'],
@@ -64,14 +74,17 @@ class GoogleLoginApi(APIView):
         if created:
             picture_url = user_data.get('picture', '')
             if picture_url:
-                user.profile.get_photo_from_url(picture_url)
+                try:
+                    user.profile.get_photo_from_url(picture_url)
+                except oauth.OAuthError:
+                    pass
 
         email_domain = user.email.split('@')[1]
 
         if email_domain == 'nltu.edu.ua':
             user.profile.is_teacher = True
 
-        user.save()
+        user.profile.save()
 
         response_url = f'{BASE_FRONTEND_URL}/login/success/?user_id={user.id}'
 
@@ -80,41 +93,67 @@ class GoogleLoginApi(APIView):
         response.set_cookie('user_id', user.id)
         return response
 
-    def google_get_access_token(self, *, code: str, redirect_uri: str) -> str:
-        data = {
-            'grant_type': 'authorization_code',
-            'client_id': '163959136765-5qj37lcjnv2g8hci1sjksr5nvj1jnlqj.apps.googleusercontent.com',
-            'client_secret': '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',
-            'redirect_uri': redirect_uri,
-            'code': code,
-        }
-        response = requests.post(self.GOOGLE_ACCESS_TOKEN_OBTAIN_URL, data=data)
-        if not response.ok:
-            raise ValidationError('Failed to obtain access token from Google.')
-        access_token = response.json()['access_token']
-        return access_token
-
-    def google_get_user_info(self, *, access_token: str):
-        response = requests.get(
-            self.GOOGLE_USER_INFO_URL,
-            params={'access_token': access_token}
-        )
 
-        if not response.ok:
-            raise ValidationError('Failed to obtain user info from Google.')
+google_login_callback = GoogleLoginApi.as_view()
 
-        return response.json()
 
+class ChatCursorPagination(CursorPagination):
+    ordering = ('-last_activity', '-id')
+
+
+def chat_list_validator(view, request, *args, **kwargs):
+    return list(Chat.objects.filter(users=request.user).order_by('id').values_list('id', 'version', 'last_activity'))
 
-google_login_callback = GoogleLoginApi.as_view()
+
+def chat_validator(view, request, pk=None, **kwargs):
+    if not str(pk).isdigit():
+        return None
+    return Chat.objects.filter(pk=pk, users=request.user).values_list('version', 'last_activity').first()
+
+
+def attach_latest_messages(chats):
+    pairs = Q()
+    for chat in chats:
+        if chat.latest_number is not None:
+            pairs |= Q(chat_id=chat.id, number=chat.latest_number)
+    messages = {}
+    if pairs:
+        messages = {message.chat_id: message
+                    for message in Message.objects.filter(pairs).select_related('user__profile')}
+    for chat in chats:
+        chat.latest_messages = [messages[chat.id]] if chat.id in messages else []
 
 
 class ChatViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
+    pagination_class = ChatCursorPagination
     http_method_names = ['get', 'head', 'options', 'post', 'patch', 'delete']
 
     def get_queryset(self):
-        return Chat.objects.filter(users=self.request.user)
+        queryset = Chat.objects.filter(users=self.request.user)
+        if self.action == 'list':
+            # Evaluated only for the rows of the page, each as a backward scan of the (chat, number) index.
+            latest_number = Message.objects.filter(chat=OuterRef('pk')).order_by('-number').values('number')[:1]
+            queryset = queryset.annotate(latest_number=Subquery(latest_number)).prefetch_related('users')
+        elif self.action == 'retrieve':
+            queryset = queryset.select_related('creator__profile__group', 'group').prefetch_related(
+                Prefetch('users', queryset=User.objects.select_related('profile__group')),
+            )
+        return queryset
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if self.action == 'list' and page is not None:
+            attach_latest_messages(page)
+        return page
+
+    @conditional(chat_list_validator)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional(chat_validator)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -198,6 +237,22 @@ class ChatViewSet(viewsets.ModelViewSet):
         else:
             return Response({'exists': True, 'chat_id': chat.id})
 
+    @action(detail=True, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        instance = self.get_object()
+
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'error': 'Unsupported export format.'}, status=400)
+
+        content = export_chat_history(instance, export_format)
+        if isinstance(request._request, ASGIRequest):
+            content = stream_async(content)
+
+        response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="chat_{instance.id}.{export_format}"'
+        return response
+
     @action(detail=True, methods=['post'])
     def leave_chat(self, request, *args, **kwargs):
         sender = request.user
@@ -262,18 +317,39 @@ class ChatViewSet(viewsets.ModelViewSet):
         return Response({'status': 'ok'})
 
 
+def message_list_validator(view, request, *args, **kwargs):
+    chat_id = request.query_params.get('chat_id')
+    if not chat_id or not chat_id.isdigit():
+        return None
+    chats = Chat.objects.filter(pk=chat_id, users=request.user)
+    # Messages never change after they are sent, except for pinning, which bumps the chat's version like edits of
+    # the members embedded as authors do
+    if request.query_params.get('pinned') == '1':
+        return chats.values_list('version').first()
+    last_number = Message.objects.filter(chat=OuterRef('pk')).order_by('-number').values('number')[:1]
+    return chats.annotate(last_number=Subquery(last_number)).values_list('version', 'last_number').first()
+
+
 class MessageViewSet(viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = msg_serializers.MessageSerializer
     permission_classes = (IsAuthenticated,)
     http_method_names = ['get', 'post', 'head', 'options']
 
+    @conditional(message_list_validator)
     def list(self, request, *args, **kwargs):
         try:
             queryset = self.get_queryset()
         except ValidationError as e:
             return Response({'error': e.detail[0]}, status=e.status_code)
 
+        if request.query_params.get('pinned') == '1':
+            if request.query_params.get('starting_number') is None:
+                return self.list_pinned()
+        else:
+            queryset = MessageHistory.for_queryset(queryset, request.query_params['chat_id'],
+                                                   request.query_params.get('starting_number'))
+
         page = self.paginate_queryset(queryset)
 
         if page is not None:
@@ -283,6 +359,13 @@ class MessageViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    def list_pinned(self):
+        data = get_pinned_messages(self.chat, self.request)
+        page = self.paginate_queryset(data)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(data)
+
     def retrieve(self, request, *args, **kwargs):
         return Response({'error': 'Method not allowed.'}, status=405)
 
@@ -292,6 +375,9 @@ class MessageViewSet(viewsets.ModelViewSet):
         if not chat_id:
             return Response({'error': 'Chat id is required.'}, status=400)
 
+        if not str(chat_id).isdigit():
+            return Response({'error': 'This chat does not exist.'}, status=404)
+
         try:
             chat = Chat.objects.get(id=chat_id)
         except Chat.DoesNotExist:
@@ -300,6 +386,12 @@ class MessageViewSet(viewsets.ModelViewSet):
         if not chat.is_user_in_chat(request.user):
             return Response({'error': 'You are not allowed to send messages to this chat.'}, status=403)
 
+        # Only members take tokens, so outsiders cannot drain the bucket of a chat they are not in
+        retry_after = check_message_rate(request.user.id, chat.id)
+        if retry_after:
+            return Response({'error': 'Too many messages, try again later.'}, status=429,
+                            headers={'Retry-After': str(math.ceil(retry_after))})
+
         text = request.data.get('text')
         file = request.data.get('file')
 
@@ -309,28 +401,24 @@ class MessageViewSet(viewsets.ModelViewSet):
         if text and file:
             return Response({'error': 'Message text and file are mutually exclusive.'}, status=400)
 
-        if text:
-            message = Message.objects.create(text=text, user=request.user, chat=chat)
-        else:
-            message = Message.objects.create(file=file, user=request.user, chat=chat)
-
-        serializer = self.get_serializer(message)
-
-        channel_layer = get_channel_layer()
-        group_name = f'chat_{chat.id}'
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                'type': 'chat_message',
-                'message': serializer.data
-            }
-        )
+        try:
+            with write_admission.admit():
+                if text:
+                    message = Message.objects.create(text=text, user=request.user, chat=chat)
+                else:
+                    message = Message.objects.create(file=file, user=request.user, chat=chat)
+
+                serializer = self.get_serializer(message)
+
+                broadcast_message(chat.id, serializer.data)
+        except Overloaded:
+            return Response({'error': 'Server is busy, try again later.'}, status=503, headers={'Retry-After': '1'})
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=201, headers=headers)
 
     def get_queryset(self):
-        if self.action in ['pin_message', 'unpin_message']:
+        if self.action in ['pin_message', 'unpin_message', 'thumbnail']:
             return Message.objects.filter(chat__users=self.request.user)
         chat_id = self.request.query_params.get('chat_id')
 
@@ -345,7 +433,8 @@ class MessageViewSet(viewsets.ModelViewSet):
         if not message_chat.is_user_in_chat(self.request.user):
             raise ValidationError(detail='You are not allowed to see this chat.', code=403)
 
-        queryset = Message.objects.filter(chat=message_chat)
+        self.chat = message_chat
+        queryset = Message.objects.filter(chat=message_chat).select_related('user__profile')
 
         starting_number = self.request.query_params.get('starting_number')
         if starting_number is not None:
@@ -357,6 +446,33 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         return queryset.order_by('-number')
 
+    @action(detail=True, methods=['get'], name='thumbnail')
+    def thumbnail(self, request, *args, **kwargs):
+        size = request.query_params.get('size', str(settings.THUMBNAIL_SIZES[0]))
+        if not size.isdigit() or int(size) not in settings.THUMBNAIL_SIZES:
+            return Response({'error': f'Size must be one of {list(settings.THUMBNAIL_SIZES)}.'}, status=400)
+
+        instance = self.get_object()
+        if not instance.file:
+            return Response({'error': 'This message has no file.'}, status=404)
+
+        try:
+            thumbnail, dimensions = get_thumbnail_cache().get(instance.file, int(size))
+        except ThumbnailError:
+            return Response({'error': 'This file has no preview.'}, status=404)
+        except ThumbnailUnavailable:
+            return Response({'error': 'Preview is not ready, try again later.'}, status=503,
+                            headers={'Retry-After': '1'})
+
+        if dimensions and instance.file_width is None:
+            Message.objects.filter(pk=instance.pk).update(file_width=dimensions[0], file_height=dimensions[1])
+            bump_chat_versions([instance.chat_id])
+
+        response = FileResponse(thumbnail, content_type='image/jpeg')
+        # A message's file never changes, neither do its thumbnails
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
     @action(detail=True, methods=['post'], name='pin_message')
     def pin_message(self, request, *args, **kwargs):
         sender = request.user
@@ -370,7 +486,7 @@ class MessageViewSet(viewsets.ModelViewSet):
             return Response({'error': 'You are not allowed to pin messages in this chat.'}, status=403)
 
         instance.pinned = True
-        instance.save()
+        instance.save(update_fields=['pinned'])
         return Response({'status': 'ok'})
 
     @action(detail=True, methods=['post'], name='unpin_message')
@@ -386,12 +502,34 @@ class MessageViewSet(viewsets.ModelViewSet):
             return Response({'error': 'You are not allowed to unpin messages in this chat.'}, status=403)
 
         instance.pinned = False
-        instance.save()
+        instance.save(update_fields=['pinned'])
         return Response({'status': 'ok'})
 
 
+ME_VALIDATOR_FIELDS = (
+    'username', 'email', 'first_name', 'last_name', 'profile__photo', 'profile__is_teacher', 'profile__patronymic',
+    'profile__diploma_topic', 'profile__diploma_supervisor_1', 'profile__diploma_supervisor_2',
+    'profile__diploma_reviewer', 'profile__group_id', 'profile__group__name', 'profile__group__study_year',
+    'profile__group__speciality', 'profile__group__institute', 'profile__group__faculty', 'profile__group__degree',
+    'profile__group__information', 'profile__group__methodological_guide',
+)
+
+
+def me_validator(view, request, *args, **kwargs):
+    # request.user may come from the authentication's user cache. The row is read fresh and the view serializes this
+    # same instance, so the body always matches the ETag of the columns DetailedUserSerializer reads.
+    view.fresh_user = User.objects.select_related('profile__group').get(pk=request.user.pk)
+    values = []
+    for path in ME_VALIDATOR_FIELDS:
+        value = view.fresh_user
+        for name in path.split('__'):
+            value = getattr(value, name, None)
+        values.append(str(value) if isinstance(value, FieldFile) else value)
+    return tuple(values)
+
+
 class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('profile__group')
     serializer_class = msg_serializers.UserSerializer
     permission_classes = (IsAuthenticated,)
     filter_backends = (filters.SearchFilter,)
@@ -421,27 +559,17 @@ class UserViewSet(viewsets.ModelViewSet):
         except Group.DoesNotExist:
             return Response({'error': 'Invalid code'}, status=400)
 
-        try:
-            group_chat = Chat.objects.get(type=Chat.ChatTypes.DIPLOMA, group=group)
-        except Chat.DoesNotExist:
-            group_chat = Chat.objects.create(name=f'Дипломний чат {group.name}', type=Chat.ChatTypes.DIPLOMA,
-                                             group=group)
-            group_users = Profile.objects.filter(group=group)
-            for user in group_users:
-                group_chat.users.add(user.user)
-            group_chat.save()
-
-        group_chat.users.add(request.user)
-
+        # Saving the profile moves the user from their old diploma chat into the group's one
         user = request.user
         user.profile.group = group
-        user.save()
+        user.profile.save()
         serializer = self.get_serializer(user)
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'], name='Get me')
+    @conditional(me_validator)
     def me(self, request):
-        serializer = self.get_serializer(request.user)
+        serializer = self.get_serializer(self.fresh_user)
         return Response(serializer.data)
 
     @action(detail=False, methods=['get'], name='Print document')
@@ -478,6 +606,9 @@ class UserViewSet(viewsets.ModelViewSet):
         except DocumentTemplate.DoesNotExist:
             return Response({'error': 'Invalid document name.'}, status=400)
 
+        # docxtpl pulls in python-docx, lxml and Jinja2, it is only loaded when a document is printed
+        from docxtpl import DocxTemplate
+
         document = DocxTemplate(document_template.template_file.path)
         document.render(context)
         file = BytesIO()
@@ -486,12 +617,30 @@ class UserViewSet(viewsets.ModelViewSet):
         return FileResponse(file, as_attachment=True, filename=document_name)
 
 
+def document_template_list_validator(view, request, *args, **kwargs):
+    return list(DocumentTemplate.objects.order_by('pk').values_list('pk', 'name', 'button_text'))
+
+
+def document_template_validator(view, request, pk=None, **kwargs):
+    if not str(pk).isdigit():
+        return None
+    return DocumentTemplate.objects.filter(pk=pk).values_list('name', 'button_text').first()
+
+
 class DocumentTemplateViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = DocumentTemplate.objects.all()
     serializer_class = msg_serializers.DocumentTemplateSerializer
     permission_classes = (IsAuthenticated,)
     http_method_names = ['get', 'head', 'options']
 
+    @conditional(document_template_list_validator)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional(document_template_validator)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 
 class LogoutView(APIView):
     permission_classes = (IsAuthenticated,)
@@ -502,3 +651,49 @@ class LogoutView(APIView):
 
 
 logout_view = LogoutView.as_view()
+
+
+@authentication_classes([])
+@permission_classes([])
+class TokenObtainView(APIView):
+    def post(self, request):
+        email = request.data.get('email')
+        password = request.data.get('password')
+        if not email or not password:
+            return Response({'error': 'Email and password are required.'}, status=400)
+
+        user = authenticate(request, username=email, password=password)
+        if user is None:
+            return Response({'error': 'Invalid credentials.'}, status=401)
+        return Response(create_token_pair(user))
+
+
+@authentication_classes([])
+@permission_classes([])
+class TokenRefreshView(APIView):
+    def post(self, request):
+        refresh = request.data.get('refresh')
+        if not refresh:
+            return Response({'error': 'Refresh token is required.'}, status=400)
+
+        try:
+            payload = decode_token(refresh, 'refresh')
+        except AuthenticationFailed as e:
+            return Response({'error': e.detail}, status=401)
+
+        user = User.objects.filter(pk=payload['user_id'], is_active=True).first()
+        if user is None or user.get_session_auth_hash()[:16] != payload.get('auth_hash'):
+            return Response({'error': 'Invalid token.'}, status=401)
+        return Response(create_token_pair(user))
+
+
+class WebSocketTicketView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        return Response({'ticket': create_ws_ticket(request.user), 'expires_in': settings.WS_TICKET_MAX_AGE})
+
+
+token_obtain_view = TokenObtainView.as_view()
+token_refresh_view = TokenRefreshView.as_view()
+ws_ticket_view = WebSocketTicketView.as_view()
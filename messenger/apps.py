@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class MessengerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messenger'
+
+    def ready(self):
+        from . import authentication  # noqa: F401 registers the user cache invalidation receivers
+        from . import membership  # noqa: F401 registers the diploma chat membership receivers
+        from . import conditional  # noqa: F401 registers the chat version receivers
+        from .db import configure_sqlite
+
+        connection_created.connect(configure_sqlite, dispatch_uid='messenger.configure_sqlite')
+
+        if settings.WS_PERMESSAGE_DEFLATE:
+            # The daphne app has already imported the server, this adds no import cost
+            from .wire import enable_permessage_deflate
+
+            enable_permessage_deflate()
@@ -0,0 +1,229 @@
+import gzip
+import heapq
+import json
+import os
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Chat, Message, MessageSegment, User
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MESSAGE_FIELDS = tuple(field.attname for field in Message._meta.concrete_fields)
+
+
+def get_archive_root():
+    return str(getattr(settings, 'MESSAGE_ARCHIVE_ROOT', os.path.join(settings.BASE_DIR, 'archive')))
+
+
+def open_segment(path, codec, mode='r'):
+    if codec == MessageSegment.Codecs.GZIP:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if codec == MessageSegment.Codecs.ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured('zstandard must be installed to use zstd message segments.')
+        return zstandard.open(path, mode + 't', encoding='utf-8')
+    raise ImproperlyConfigured(f'Unknown message segment codec: {codec}')
+
+
+def segment_extension(codec):
+    return '.jsonl.zst' if codec == MessageSegment.Codecs.ZSTD else '.jsonl.gz'
+
+
+def write_segment(chat_id, rows, codec):
+    first_number = rows[0]['number']
+    last_number = rows[-1]['number']
+    path = os.path.join(f'chat_{chat_id}', f'{first_number:010d}-{last_number:010d}{segment_extension(codec)}')
+    full_path = os.path.join(get_archive_root(), path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    tmp_path = full_path + '.tmp'
+    with open_segment(tmp_path, codec, 'w') as segment_file:
+        for row in rows:
+            # DjangoJSONEncoder truncates datetimes to milliseconds, the archive keeps them exact.
+            row = dict(row, timestamp=row['timestamp'].isoformat())
+            segment_file.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+            segment_file.write('\n')
+    os.replace(tmp_path, full_path)
+    return path
+
+
+def iter_segment(segment):
+    with open_segment(os.path.join(get_archive_root(), segment.path), segment.codec) as segment_file:
+        for line in segment_file:
+            row = json.loads(line)
+            row['timestamp'] = parse_datetime(row['timestamp'])
+            yield row
+
+
+def read_segment(segment):
+    return list(iter_segment(segment))
+
+
+def archived_upto(chat_id):
+    return MessageSegment.objects.filter(chat_id=chat_id).aggregate(number=Max('last_number'))['number']
+
+
+def archive_chat(chat, older_than, segment_size=None, codec=None):
+    segment_size = segment_size or settings.MESSAGE_ARCHIVE_SEGMENT_SIZE
+    codec = codec or settings.MESSAGE_ARCHIVE_CODEC
+
+    latest_number = Message.objects.filter(chat=chat).aggregate(number=Max('number'))['number']
+    if latest_number is None:
+        return 0
+
+    # The latest message always stays hot, so numbering and chat previews keep working. Pinned messages stay hot
+    # too, and nothing below the current boundary is archived again, so segments of a chat never overlap.
+    queryset = Message.objects.filter(chat=chat, timestamp__lt=older_than, pinned=False, number__lt=latest_number)
+    boundary = archived_upto(chat.id)
+    if boundary is not None:
+        queryset = queryset.filter(number__gt=boundary)
+    queryset = queryset.order_by('number')
+
+    archived = 0
+    while True:
+        rows = list(queryset.values(*MESSAGE_FIELDS)[:segment_size])
+        if not rows:
+            break
+        path = write_segment(chat.id, rows, codec)
+        with transaction.atomic():
+            MessageSegment.objects.create(chat=chat, first_number=rows[0]['number'],
+                                          last_number=rows[-1]['number'], count=len(rows), path=path, codec=codec)
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        archived += len(rows)
+        queryset = queryset.filter(number__gt=rows[-1]['number'])
+    return archived
+
+
+def archive_messages(days=None, chats=None):
+    days = settings.MESSAGE_ARCHIVE_AFTER_DAYS if days is None else days
+    if chats is None:
+        chats = Chat.objects.all()
+    older_than = timezone.now() - timedelta(days=days)
+    return {chat.id: archive_chat(chat, older_than) for chat in chats}
+
+
+class MessageHistory:
+    """Newest-first message sequence of a chat that reads through to archived segments below the hot range."""
+
+    def __init__(self, queryset, chat_id, boundary, starting_number=None):
+        self.chat_id = chat_id
+        self.starting_number = starting_number
+        self.hot = queryset.filter(number__gt=boundary)
+        self.leftovers = queryset.filter(number__lte=boundary)
+        self.segments = MessageSegment.objects.filter(chat_id=chat_id).order_by('-last_number')
+        if starting_number is not None:
+            self.segments = self.segments.filter(first_number__lte=starting_number)
+        self.ordered = True
+        self._hot_count = None
+        self._count = None
+
+    @classmethod
+    def for_queryset(cls, queryset, chat_id, starting_number=None):
+        boundary = archived_upto(chat_id)
+        if boundary is None:
+            return queryset
+        if starting_number is not None:
+            starting_number = int(starting_number)
+        return cls(queryset, chat_id, boundary, starting_number)
+
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.hot.count()
+        return self._hot_count
+
+    def count(self):
+        if self._count is None:
+            count = self.hot_count() + self.leftovers.count()
+            for segment in self.segments:
+                if self.starting_number is None or segment.last_number <= self.starting_number:
+                    count += segment.count
+                else:
+                    count += len(self._segment_rows(segment))
+            self._count = count
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        stop = item.stop if item.stop is not None else self.count()
+
+        hot_count = self.hot_count()
+        messages = []
+        if start < hot_count:
+            messages.extend(self.hot.select_related('user__profile')[start:min(stop, hot_count)])
+        if stop > hot_count:
+            messages.extend(self._cold(max(start - hot_count, 0), stop - hot_count))
+        return messages
+
+    def _segment_rows(self, segment):
+        rows = read_segment(segment)
+        if self.starting_number is not None:
+            rows = [row for row in rows if row['number'] <= self.starting_number]
+        return rows
+
+    def _cold(self, start, stop):
+        leftovers = deque(self.leftovers.select_related('user__profile'))
+        limit = stop - start
+        skip = start
+        messages = []
+
+        def take(message):
+            nonlocal skip
+            if skip:
+                skip -= 1
+            else:
+                messages.append(message)
+
+        for segment in self.segments:
+            while leftovers and leftovers[0].number > segment.last_number:
+                take(leftovers.popleft())
+            if len(messages) >= limit:
+                break
+
+            fully_covered = self.starting_number is None or segment.last_number <= self.starting_number
+            interleaved = bool(leftovers) and leftovers[0].number >= segment.first_number
+            if fully_covered and not interleaved and skip >= segment.count:
+                skip -= segment.count
+                continue
+
+            inner = []
+            while leftovers and leftovers[0].number >= segment.first_number:
+                inner.append(leftovers.popleft())
+            for message in heapq.merge(self._segment_messages(segment), inner, key=lambda m: -m.number):
+                take(message)
+            if len(messages) >= limit:
+                break
+
+        while leftovers and len(messages) < limit:
+            take(leftovers.popleft())
+        return self._attach_users(messages[:limit])
+
+    def _segment_messages(self, segment):
+        for row in reversed(self._segment_rows(segment)):
+            message = Message(**row)
+            message.archived = True
+            yield message
+
+    def _attach_users(self, messages):
+        archived = [message for message in messages if not Message.user.is_cached(message)]
+        users = User.objects.select_related('profile').in_bulk({message.user_id for message in archived})
+        for message in archived:
+            message.user = users[message.user_id]
+        return messages
@@ -0,0 +1,127 @@
+from datetime import timedelta
+
+import jwt
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import Profile, User
+
+
+TOKEN_ALGORITHM = 'HS256'
+WS_TICKET_SALT = 'messenger.ws_ticket'
+
+
+def user_cache_key(user_id):
+    return f'messenger:auth_user:{user_id}'
+
+
+def get_cached_user(user_id):
+    key = user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.select_related('profile').filter(pk=user_id).first()
+        if user is None:
+            return None
+        cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+    return user
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    cache.delete(user_cache_key(instance.pk))
+
+
+@receiver(post_save, sender=Profile)
+def invalidate_cached_profile_user(sender, instance, **kwargs):
+    cache.delete(user_cache_key(instance.user_id))
+
+
+async def aget_cached_user(user_id):
+    user = await cache.aget(user_cache_key(user_id))
+    if user is None:
+        user = await database_sync_to_async(get_cached_user)(user_id)
+    return user
+
+
+def create_token(user, token_type):
+    lifetime = settings.ACCESS_TOKEN_LIFETIME if token_type == 'access' else settings.REFRESH_TOKEN_LIFETIME
+    now = timezone.now()
+    payload = {
+        'user_id': user.pk,
+        'type': token_type,
+        'iat': now,
+        'exp': now + lifetime,
+    }
+    if token_type == 'refresh':
+        # Changing the password invalidates the refresh tokens issued before it
+        payload['auth_hash'] = user.get_session_auth_hash()[:16]
+    return jwt.encode(payload, settings.SECRET_KEY, algorithm=TOKEN_ALGORITHM)
+
+
+def create_token_pair(user):
+    return {
+        'access': create_token(user, 'access'),
+        'refresh': create_token(user, 'refresh'),
+        'expires_in': int(settings.ACCESS_TOKEN_LIFETIME / timedelta(seconds=1)),
+    }
+
+
+def decode_token(token, token_type):
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[TOKEN_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationFailed('Token has expired.')
+    except jwt.InvalidTokenError:
+        raise AuthenticationFailed('Invalid token.')
+    if payload.get('type') != token_type:
+        raise AuthenticationFailed('Invalid token type.')
+    return payload
+
+
+def create_ws_ticket(user):
+    return signing.dumps({'user_id': user.pk}, salt=WS_TICKET_SALT)
+
+
+def read_ws_ticket(ticket):
+    try:
+        return signing.loads(ticket, salt=WS_TICKET_SALT, max_age=settings.WS_TICKET_MAX_AGE)['user_id']
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+class AccessTokenAuthentication(BaseAuthentication):
+    """Authenticates `Authorization: Bearer <access token>` headers.
+
+    Tokens are verified with HMAC only and users are resolved through a short-lived cache, so a request needs neither
+    a password hash nor a database query.
+    """
+
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+
+        try:
+            token = auth[1].decode()
+        except UnicodeDecodeError:
+            raise AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+
+        payload = decode_token(token, 'access')
+        user = get_cached_user(payload['user_id'])
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        return user, payload
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="api"'
@@ -0,0 +1,41 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .wire import pack
+
+
+def chat_group_name(chat_id):
+    return f'chat_{chat_id}'
+
+
+def build_envelope(data):
+    """Serializes a chat event once for all recipients.
+
+    `text` holds the JSON frame every socket receives unchanged. With BROADCAST_MSGPACK the same payload is also
+    packed into `bytes`, the frame of sockets that use the msgpack subprotocol. `sent_at` stays outside the payload
+    and is only used for the delivery delay metric.
+    """
+    payload = dict(data, type='chat_message')
+    envelope = {
+        'type': 'chat.message',
+        'text': json.dumps(payload),
+        'sent_at': time.time(),
+    }
+    if settings.BROADCAST_MSGPACK:
+        envelope['bytes'] = pack(payload)
+    return envelope
+
+
+def broadcast_message(chat_id, data, channel_layer=None):
+    channel_layer = channel_layer or get_channel_layer()
+    envelope = build_envelope(data)
+
+    started = time.perf_counter()
+    async_to_sync(channel_layer.group_send)(chat_group_name(chat_id), envelope)
+    if settings.METRICS_ENABLED:
+        metrics.ws_group_send_duration.observe(time.perf_counter() - started)
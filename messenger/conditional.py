@@ -0,0 +1,100 @@
+import hashlib
+from functools import wraps
+
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response, patch_vary_headers, quote_etag
+
+from .models import Chat, Group, Message, Profile, User
+
+
+def make_etag(request, validator):
+    # The representation depends on the negotiated format and the query string as much as on the data
+    key = repr((request.accepted_media_type, request.get_full_path(), validator))
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def conditional(get_validator):
+    """Answers GET requests whose If-None-Match still matches with 304 Not Modified, before any serialization.
+
+    `get_validator(view, request, *args, **kwargs)` returns something cheap that changes whenever the response
+    would, such as version counters or the newest message number, or None to skip the check (e.g. when the object
+    does not exist and the view reports the error itself). Full responses carry the resulting ETag.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            validator = get_validator(self, request, *args, **kwargs)
+            if validator is None:
+                return method(self, request, *args, **kwargs)
+
+            etag = make_etag(request, validator)
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is None:
+                response = method(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            else:
+                response = not_modified
+            response['ETag'] = etag
+            patch_vary_headers(response, ('Accept',))
+            return response
+        return wrapper
+    return decorator
+
+
+# Saved alone by logins and password changes, no representation embeds them
+UNEMBEDDED_USER_FIELDS = frozenset({'last_login', 'password'})
+
+
+def bump_chat_versions(chat_ids):
+    """Marks chats as changed, for changes that move neither their last activity nor their newest message."""
+    if chat_ids:
+        Chat.objects.filter(pk__in=list(chat_ids)).update(version=F('version') + 1)
+
+
+def bump_member_chat_versions(condition):
+    """Marks the chats whose members match `condition` as changed, for edits of the users they embed."""
+    Chat.objects.filter(pk__in=Chat.objects.filter(condition).values('pk')).update(version=F('version') + 1)
+
+
+@receiver(post_save, sender=Chat)
+def chat_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        bump_chat_versions([instance.pk])
+
+
+@receiver(post_save, sender=Message)
+def message_pinned(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # New messages move the chat's last activity and newest number, only pinning changes a message afterwards
+    if not created and not raw and (update_fields is None or 'pinned' in update_fields):
+        bump_chat_versions([instance.chat_id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if created or raw or (update_fields is not None and set(update_fields) <= UNEMBEDDED_USER_FIELDS):
+        return
+    bump_member_chat_versions(Q(users=instance.pk))
+
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, created, raw=False, **kwargs):
+    # A new profile belongs to a user without chats yet
+    if not created and not raw:
+        bump_member_chat_versions(Q(users=instance.user_id))
+
+
+@receiver(post_save, sender=Group)
+def group_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        bump_member_chat_versions(Q(group=instance.pk) | Q(users__profile__group=instance.pk))
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def chat_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        bump_chat_versions(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear' and not reverse:
+        bump_chat_versions([instance.pk])
@@ -1,10 +1,19 @@
 # chat/consumers.py
 import json
+import time
+from urllib.parse import parse_qs
+
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
+from django.conf import settings
 
+from . import metrics
+from .broadcast import broadcast_message, chat_group_name
 from .models import Chat, Message
+from .ratelimit import Overloaded, check_message_rate, write_admission
 from .serializers import MessageSerializer
+from .snapshot import build_snapshot
+from .wire import MSGPACK_SUBPROTOCOL, pack, unpack
 
 
 class ChatConsumer(WebsocketConsumer):
@@ -22,7 +31,7 @@ class ChatConsumer(WebsocketConsumer):
             self.close()
             return
 
-        self.chat_group_name = 'chat_%s' % self.chat_id
+        self.chat_group_name = chat_group_name(self.chat_id)
 
         # Join room group
         async_to_sync(self.channel_layer.group_add)(
@@ -30,11 +39,23 @@ class ChatConsumer(WebsocketConsumer):
             self.channel_name
         )
 
-        self.accept()
+        if settings.METRICS_ENABLED:
+            metrics.ws_connects.inc()
+            metrics.ws_connections.inc()
+            metrics.ws_group_members.labels(self.chat_group_name).inc()
+
+        # Clients offering the msgpack subprotocol get binary msgpack frames instead of JSON text
+        self.msgpack = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.accept(MSGPACK_SUBPROTOCOL if self.msgpack else None)
+
+        # ?snapshot=N sends the last N messages as the first frame, sparing the client a GET /api/messages
+        snapshot = parse_qs(self.scope.get('query_string', b'').decode()).get('snapshot')
+        if snapshot and snapshot[0].isdigit() and int(snapshot[0]) > 0 and self.chat.is_user_in_chat(user):
+            self.send_frame(build_snapshot(self.chat, int(snapshot[0])))
 
     def disconnect(self, close_code):
         user = self.scope['user']
-        if not user.is_authenticated:
+        if not user.is_authenticated or not hasattr(self, 'chat_group_name'):
             return
         # Leave room group
         async_to_sync(self.channel_layer.group_discard)(
@@ -42,32 +63,67 @@ class ChatConsumer(WebsocketConsumer):
             self.channel_name
         )
 
+        if settings.METRICS_ENABLED:
+            metrics.ws_disconnects.inc()
+            metrics.ws_connections.dec()
+            members = metrics.ws_group_members.labels(self.chat_group_name)
+            members.dec()
+            if members.value <= 0:
+                metrics.ws_group_members.remove(self.chat_group_name)
+
     # Receive message from WebSocket
-    def receive(self, text_data):
+    def receive(self, text_data=None, bytes_data=None):
+        if settings.METRICS_ENABLED:
+            metrics.ws_frames_received.inc()
+
         user = self.scope['user']
         if not user.is_authenticated:
             self.close()
             return
 
-        text_data_json = json.loads(text_data)
-        text = text_data_json['text']
+        if not self.chat.is_user_in_chat(user):
+            self.send_error('forbidden')
+            return
 
-        message = Message(chat=self.chat, user=user, text=text)
-        message.save()
+        retry_after = check_message_rate(user.id, self.chat.id)
+        if retry_after:
+            self.send_error('rate_limited', retry_after=round(retry_after, 3))
+            return
 
-        # serialise message
-        serialized_message = MessageSerializer(message).data
-        serialized_message['type'] = 'chat_message'
+        data = unpack(bytes_data) if bytes_data is not None else json.loads(text_data)
+        text = data['text']
 
-        # Send message to room group
-        async_to_sync(self.channel_layer.group_send)(
-            self.chat_group_name,
-            serialized_message
-        )
+        try:
+            # The handlers of every sync consumer run one at a time on the single thread of database_sync_to_async,
+            # so socket writes never overlap each other and are only shed when REST writes have filled the process.
+            with write_admission.admit():
+                message = Message(chat=self.chat, user=user, text=text)
+                message.save()
+
+                # Send message to room group
+                broadcast_message(self.chat_id, MessageSerializer(message).data, self.channel_layer)
+        except Overloaded:
+            self.send_error('overloaded')
+
+    def send_error(self, error, **data):
+        self.send_frame({'type': 'error', 'error': error, **data})
+
+    def send_frame(self, data):
+        if self.msgpack:
+            self.send(bytes_data=pack(data))
+        else:
+            self.send(text_data=json.dumps(data))
 
     # Receive message from room group
     def chat_message(self, event):
-        message = event
-
-        # Send message to WebSocket
-        self.send(text_data=json.dumps(message))
+        sent_at = event.get('sent_at')
+        if settings.METRICS_ENABLED and sent_at:
+            metrics.ws_delivery_delay.observe(time.time() - sent_at)
+
+        # The payload was serialized once by the publisher, see broadcast.build_envelope
+        if not self.msgpack:
+            self.send(text_data=event['text'])
+        elif 'bytes' in event:
+            self.send(bytes_data=event['bytes'])
+        else:
+            self.send(bytes_data=pack(json.loads(event['text'])))
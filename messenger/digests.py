@@ -0,0 +1,114 @@
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Count, F, Max, Q, Value
+from django.db.models.functions import Coalesce
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import metrics
+from .models import Chat, Profile
+
+
+def digest_rows(now):
+    """Returns the query behind collect_digests().
+
+    The time window is part of the join, so each membership reads only its chat's messages since the member's last
+    digest from the (chat, timestamp) index instead of every message of the chat.
+    """
+    since = Coalesce(F('user__profile__email_digest_sent_at'), Value(now - settings.EMAIL_DIGEST_LOOKBACK))
+    # Applied inside the aggregates, as a negated filter on the messages would become a subquery
+    others = ~Q(chat__message__user_id=F('user_id'))
+    return (
+        Chat.users.through.objects
+        # Without a profile there is nowhere to record the digest, so it would be sent on every run
+        .filter(user__is_active=True, user__profile__isnull=False)
+        .exclude(user__email='')
+        .filter(chat__message__timestamp__gt=since, chat__message__timestamp__lte=now)
+        .values('user_id', 'user__email', 'user__first_name', 'chat_id', 'chat__name')
+        .annotate(unread=Count('chat__message', filter=others),
+                  last_message_at=Max('chat__message__timestamp', filter=others))
+        .filter(unread__gt=0)
+        .order_by('user_id', '-last_message_at')
+    )
+
+
+def collect_digests(now=None):
+    """Returns the unread messages of every user as {user_id: [row per chat]}, in a single query.
+
+    A message is unread by a member of its chat when someone else sent it after the member's last digest, or
+    within EMAIL_DIGEST_LOOKBACK for members who have never received one. Each row holds the member's address and
+    name, the chat, its unread count and the time of its latest unread message.
+    """
+    rows = digest_rows(now or timezone.now())
+    return {user_id: list(chats) for user_id, chats in groupby(rows, key=lambda row: row['user_id'])}
+
+
+def render_digest(chats):
+    context = {
+        'first_name': chats[0]['user__first_name'],
+        'chats': chats,
+        'total': sum(chat['unread'] for chat in chats),
+        'frontend_url': settings.BASE_FRONTEND_URL,
+    }
+    message = EmailMultiAlternatives(
+        subject=f'Нові повідомлення: {context["total"]}',
+        body=render_to_string('messenger/email/digest.txt', context),
+        to=[chats[0]['user__email']],
+    )
+    message.attach_alternative(render_to_string('messenger/email/digest.html', context), 'text/html')
+    return message
+
+
+def reconnect(connection):
+    """Replaces a connection broken by a failed send, returns False when the server cannot be reached again."""
+    try:
+        connection.close()
+        connection.open()
+    except OSError:
+        return False
+    return True
+
+
+def send_digests(now=None, batch_size=None, connection=None):
+    """Emails every user with unread messages a digest, returns the number of digests sent.
+
+    All digests go over one SMTP connection, each as its own message, so a rejected recipient does not take the
+    others down with it. The `email_digest_sent_at` of the accepted recipients is advanced once per batch of
+    EMAIL_DIGEST_BATCH_SIZE: a failed digest is retried by the next run, an accepted one is never sent twice. When
+    the server cannot be reached again after a failure, the remaining digests are left to the next run.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or settings.EMAIL_DIGEST_BATCH_SIZE
+    digests = list(collect_digests(now).items())
+    if not digests:
+        return 0
+
+    sent = 0
+    with connection or get_connection() as connection:
+        for start in range(0, len(digests), batch_size):
+            batch = digests[start:start + batch_size]
+            started = time.perf_counter()
+            accepted, failed, reachable = [], 0, True
+            for user_id, chats in batch:
+                try:
+                    if connection.send_messages([render_digest(chats)]):
+                        accepted.append(user_id)
+                except OSError:
+                    # smtplib.SMTPException is an OSError too
+                    failed += 1
+                    reachable = reconnect(connection)
+                    if not reachable:
+                        break
+
+            Profile.objects.filter(user_id__in=accepted).update(email_digest_sent_at=now)
+            sent += len(accepted)
+            if settings.METRICS_ENABLED:
+                metrics.email_digests_sent.inc(len(accepted))
+                metrics.email_digest_failures.inc(failed)
+                metrics.email_digest_batch_duration.observe(time.perf_counter() - started)
+            if not reachable:
+                break
+    return sent
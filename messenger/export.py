@@ -0,0 +1,101 @@
+import csv
+import heapq
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from .archive import read_segment
+from .models import Message, MessageSegment, User
+
+
+EXPORT_FIELDS = ('number', 'timestamp', 'user_id', 'first_name', 'last_name', 'email', 'text', 'file', 'pinned')
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_CHUNK_SIZE = 2000
+
+
+def iter_hot_rows(chat, chunk_size):
+    queryset = Message.objects.filter(chat=chat).select_related('user').order_by('number')
+    for message in queryset.iterator(chunk_size=chunk_size):
+        yield {
+            'number': message.number,
+            'timestamp': message.timestamp,
+            'user_id': message.user_id,
+            'first_name': message.user.first_name,
+            'last_name': message.user.last_name,
+            'email': message.user.email,
+            'text': message.text,
+            'file': message.file.name or '',
+            'pinned': message.pinned,
+        }
+
+
+def iter_archived_rows(chat):
+    users = {}
+    for segment in MessageSegment.objects.filter(chat=chat).order_by('first_number').iterator():
+        rows = read_segment(segment)
+        # The authors of a segment are loaded at once, users already seen in earlier segments are not loaded again
+        missing = {row['user_id'] for row in rows} - users.keys()
+        if missing:
+            found = User.objects.only('first_name', 'last_name', 'email').in_bulk(missing)
+            for user_id in missing:
+                user = found.get(user_id)
+                users[user_id] = {
+                    'first_name': user.first_name if user else '',
+                    'last_name': user.last_name if user else '',
+                    'email': user.email if user else '',
+                }
+        for row in rows:
+            yield {
+                'number': row['number'],
+                'timestamp': row['timestamp'],
+                'user_id': row['user_id'],
+                **users[row['user_id']],
+                'text': row['text'],
+                'file': row['file'] or '',
+                'pinned': row['pinned'],
+            }
+
+
+def iter_chat_history(chat, chunk_size=EXPORT_CHUNK_SIZE):
+    # Both sources are already ordered by number, so merging them keeps memory use constant.
+    return heapq.merge(iter_archived_rows(chat), iter_hot_rows(chat, chunk_size), key=lambda row: row['number'])
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def iter_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        yield writer.writerow([row[field] for field in EXPORT_FIELDS])
+
+
+def export_chat_history(chat, export_format='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    rows = iter_chat_history(chat, chunk_size=chunk_size)
+    if export_format == 'csv':
+        return iter_csv(rows)
+    return iter_ndjson(rows)
+
+
+async def stream_async(lines, batch_size=200):
+    # Under ASGI Django buffers synchronous iterators completely, so the rows are pulled in small batches instead.
+    next_batch = sync_to_async(lambda: ''.join(islice(lines, batch_size)))
+    while True:
+        chunk = await next_batch()
+        if not chunk:
+            break
+        yield chunk
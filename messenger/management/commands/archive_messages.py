@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from messenger.archive import archive_messages
+from messenger.models import Chat
+
+
+class Command(BaseCommand):
+    help = 'Moves old messages of every chat into compressed archive segments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive messages older than this many days (MESSAGE_ARCHIVE_AFTER_DAYS by default).')
+        parser.add_argument('--chat', type=int, action='append', dest='chats',
+                            help='Only archive the given chat id. Can be repeated.')
+
+    def handle(self, *args, **options):
+        chats = Chat.objects.all()
+        if options['chats']:
+            chats = chats.filter(id__in=options['chats'])
+
+        archived = archive_messages(days=options['days'], chats=chats.order_by('id'))
+        for chat_id, count in archived.items():
+            if count:
+                self.stdout.write(f'Chat {chat_id}: archived {count} messages')
+        self.stdout.write(self.style.SUCCESS(f'Archived {sum(archived.values())} messages'))
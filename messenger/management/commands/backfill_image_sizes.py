@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from messenger.conditional import bump_chat_versions
+from messenger.models import Message
+from messenger.thumbnails import read_image_size
+
+
+class Command(BaseCommand):
+    help = ('Reads the dimensions of image attachments sent before they were stored on the message '
+            'and writes them in bulk, so those messages get previews.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be updated.')
+
+    def handle(self, *args, **options):
+        queryset = (Message.objects.filter(file_width__isnull=True).exclude(file__isnull=True).exclude(file='')
+                    .only('pk', 'chat', 'file'))
+        field = Message._meta.get_field('file')
+
+        updated_total = skipped = missing = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            updated = []
+            for message in batch:
+                if not field.storage.exists(message.file.name):
+                    missing += 1
+                    continue
+                with message.file.open('rb') as file:
+                    size = read_image_size(file)
+                if size is None:
+                    skipped += 1
+                    continue
+                message.file_width, message.file_height = size
+                updated.append(message)
+
+            updated_total += len(updated)
+            if updated and not options['dry_run']:
+                Message.objects.bulk_update(updated, ['file_width', 'file_height'])
+                # Bulk updates send no signals, the previews change the chats' message lists
+                bump_chat_versions({message.chat_id for message in updated})
+
+        action = 'Would update' if options['dry_run'] else 'Updated'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {updated_total} images, {skipped} other files, {missing} missing'))
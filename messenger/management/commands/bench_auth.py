@@ -0,0 +1,49 @@
+import base64
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.test import APIRequestFactory
+
+from messenger.api import UserViewSet
+from messenger.authentication import AccessTokenAuthentication, create_token
+from messenger.models import User
+
+
+class Command(BaseCommand):
+    help = 'Measures single-core requests per second of GET /api/users/me with Basic and with bearer token auth.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=5, help='Seconds to run each variant for.')
+
+    def handle(self, *args, **options):
+        password = uuid.uuid4().hex
+        email = f'bench_auth_{uuid.uuid4().hex[:8]}@bench.local'
+        user = User.objects.create_user(username=email.split('@')[0], email=email, password=password)
+        try:
+            basic = base64.b64encode(f'{email}:{password}'.encode()).decode()
+            variants = (
+                ('basic', BasicAuthentication, f'Basic {basic}'),
+                ('token', AccessTokenAuthentication, f'Bearer {create_token(user, "access")}'),
+            )
+            results = {name: self.run(authentication, header, options['duration'])
+                       for name, authentication, header in variants}
+        finally:
+            user.delete()
+
+        for name, requests_per_second in results.items():
+            self.stdout.write(f'{name}: {requests_per_second:.0f} requests/s')
+        self.stdout.write(f'speedup: {results["token"] / results["basic"]:.1f}x')
+
+    def run(self, authentication, header, duration):
+        view = UserViewSet.as_view({'get': 'me'}, authentication_classes=[authentication])
+        factory = APIRequestFactory()
+
+        requests = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            response = view(factory.get('/api/users/me', HTTP_AUTHORIZATION=header))
+            assert response.status_code == 200, response.status_code
+            requests += 1
+        return requests / (time.perf_counter() - started)
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from messenger.db import sqlite_pragma_statements
+
+
+# Django's SQLite defaults: rollback journal, synchronous=FULL and a 5 second busy timeout
+DEFAULT_PRAGMAS = {'journal_mode': 'delete', 'synchronous': 'full'}
+DEFAULT_TIMEOUT = 5
+
+
+def percentile(samples, percent):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[max(0, min(len(samples) - 1, round(percent / 100 * len(samples)) - 1))]
+
+
+class Command(BaseCommand):
+    help = ('Compares SQLite write contention with the default settings and with SQLITE_PRAGMAS, '
+            'using the same read-then-insert pattern as message creation.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writes', type=int, default=300, help='Messages inserted by each writer.')
+        parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                            help='Busy timeout in seconds for the default profile.')
+
+    def handle(self, *args, **options):
+        for name, pragmas, timeout in (
+            ('default', DEFAULT_PRAGMAS, options['timeout']),
+            ('tuned', None, options['timeout']),
+        ):
+            with tempfile.TemporaryDirectory() as directory:
+                results = self.run(os.path.join(directory, 'bench.sqlite3'), sqlite_pragma_statements(pragmas),
+                                   timeout, options)
+            self.stdout.write(
+                f'{name}: {results["writes_per_second"]:.0f} writes/s, {results["reads_per_second"]:.0f} reads/s, '
+                f'{results["locked"]} "database is locked" errors, write latency p50 {results["p50_ms"]:.2f} ms, '
+                f'p99 {results["p99_ms"]:.2f} ms'
+            )
+
+    def connect(self, path, statements, timeout):
+        connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        for statement in statements:
+            connection.execute(statement)
+        return connection
+
+    def run(self, path, statements, timeout, options):
+        setup = self.connect(path, statements, timeout)
+        # The journal mode is stored in the database file, switching it under load would fail with "locked".
+        statements = [statement for statement in statements if not statement.startswith('PRAGMA journal_mode')]
+        setup.execute('CREATE TABLE message (id INTEGER PRIMARY KEY, chat_id INTEGER, number INTEGER, text TEXT)')
+        setup.execute('CREATE INDEX message_chat_number ON message (chat_id, number)')
+        setup.close()
+
+        latencies = []
+        locked = 0
+        reads = 0
+        writers_done = threading.Event()
+        lock = threading.Lock()
+
+        def open_connection():
+            nonlocal locked
+            while True:
+                try:
+                    return self.connect(path, statements, timeout)
+                except sqlite3.OperationalError:
+                    with lock:
+                        locked += 1
+
+        def write(index):
+            nonlocal locked
+            connection = open_connection()
+            chat_id = index % 4
+            for _ in range(options['writes']):
+                started = time.perf_counter()
+                try:
+                    number = connection.execute('SELECT COALESCE(MAX(number), -1) + 1 FROM message WHERE chat_id = ?',
+                                                (chat_id,)).fetchone()[0]
+                    connection.execute('INSERT INTO message (chat_id, number, text) VALUES (?, ?, ?)',
+                                       (chat_id, number, 'x' * 200))
+                except sqlite3.OperationalError:
+                    with lock:
+                        locked += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+            connection.close()
+
+        def read():
+            nonlocal reads
+            connection = open_connection()
+            while not writers_done.is_set():
+                try:
+                    connection.execute('SELECT id, number, text FROM message WHERE chat_id = 1 '
+                                       'ORDER BY number DESC LIMIT 20').fetchall()
+                except sqlite3.OperationalError:
+                    continue
+                with lock:
+                    reads += 1
+            connection.close()
+
+        writers = [threading.Thread(target=write, args=(index,)) for index in range(options['writers'])]
+        readers = [threading.Thread(target=read) for _ in range(options['readers'])]
+        started = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writers_done.set()
+        for thread in readers:
+            thread.join()
+
+        return {
+            'writes_per_second': len(latencies) / elapsed,
+            'reads_per_second': reads / elapsed,
+            'locked': locked,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
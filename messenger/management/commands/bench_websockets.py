@@ -0,0 +1,340 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.hashers import make_password
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from messenger.models import Chat, User
+
+
+BENCH_PREFIX = 'bench:'
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+    index = max(0, min(len(samples) - 1, round(percent / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def current_rss_kb(pid='self'):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class InProcessClient:
+    def __init__(self, application, path, headers):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path, headers=headers)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self, timeout):
+        # receive_from() cancels the application when it times out, so the output queue is polled directly.
+        try:
+            message = await asyncio.wait_for(self.communicator.output_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return message.get('text') or message.get('bytes')
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    # A minimal RFC 6455 client on asyncio streams: autobahn's asyncio flavour cannot be used next to Daphne,
+    # which already selected the twisted one.
+
+    def __init__(self, url, headers):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path or '/'
+        self.headers = headers
+        self.reader = None
+        self.writer = None
+        self.frames = asyncio.Queue()
+        self.pump_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (f'GET {self.path} HTTP/1.1\r\n'
+                   f'Host: {self.host}:{self.port}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   f'Sec-WebSocket-Key: {key}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n'
+                   f'Origin: {self.headers[b"origin"].decode()}\r\n'
+                   f'Cookie: {self.headers[b"cookie"].decode()}\r\n\r\n')
+        self.writer.write(request.encode())
+        response = await self.reader.readuntil(b'\r\n\r\n')
+        if response.split(b' ', 2)[1] != b'101':
+            return False
+        self.pump_task = asyncio.create_task(self.pump())
+        return True
+
+    def write_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        self.writer.write(header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+
+    async def read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self.reader.readexactly(8))
+        return first & 0x0f, await self.reader.readexactly(length)
+
+    async def send(self, text):
+        self.write_frame(0x1, text.encode())
+
+    async def pump(self):
+        try:
+            while True:
+                opcode, payload = await self.read_frame()
+                if opcode == 0x9:
+                    self.write_frame(0xa, payload)
+                elif opcode == 0x1:
+                    self.frames.put_nowait(payload.decode())
+                elif opcode == 0x2:
+                    self.frames.put_nowait(payload)
+                elif opcode == 0x8:
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+
+    async def receive(self, timeout):
+        try:
+            return await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self.write_frame(0x8, struct.pack('!H', 1000))
+        if self.pump_task:
+            self.pump_task.cancel()
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = ('Runs simulated WebSocket clients against msg.asgi.application and reports delivery latency '
+            'percentiles, throughput and memory usage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--chats', type=int, default=5)
+        parser.add_argument('--rate', type=float, default=20, help='Messages per second sent by all clients together.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to publish for.')
+        parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for in-flight deliveries.')
+        parser.add_argument('--mode', choices=('inprocess', 'daphne'), default='inprocess')
+        parser.add_argument('--url', help='ws:// address of an already running server (daphne mode). '
+                                          'A local Daphne is started when omitted. Run it with '
+                                          'RATELIMIT_ENABLED=False, or the rate limits reject most messages.')
+        parser.add_argument('--port', type=int, default=8765, help='Port for the Daphne started by the benchmark.')
+        parser.add_argument('--channel-layer', help='Channel layer backend to use in-process, '
+                                                    'e.g. channels_redis.core.RedisChannelLayer.')
+        parser.add_argument('--channel-layer-config', default='{}', help='JSON CONFIG for --channel-layer.')
+        parser.add_argument('--label', default='', help='Name of the variant, stored with the results.')
+        parser.add_argument('--output', help='Append the results as a JSON line to this file.')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['chats'] < 1 or options['rate'] <= 0:
+            raise CommandError('--clients, --chats and --rate must be positive.')
+
+        run_id = uuid.uuid4().hex[:8]
+        chats, sessions = self.create_fixtures(run_id, options['clients'], options['chats'])
+        server = None
+        try:
+            if options['mode'] == 'inprocess':
+                layers = settings.CHANNEL_LAYERS
+                if options['channel_layer']:
+                    layers = {'default': {'BACKEND': options['channel_layer'],
+                                          'CONFIG': json.loads(options['channel_layer_config'])}}
+                # The rate limits would reject most of the simulated traffic, the benchmark measures delivery
+                with override_settings(CHANNEL_LAYERS=layers, RATELIMIT_ENABLED=False):
+                    from msg.asgi import application
+
+                    factory = lambda path, headers: InProcessClient(application, path, headers)
+                    results = asyncio.run(self.run(factory, chats, sessions, options))
+                results['rss_kb'] = current_rss_kb()
+            else:
+                url = options['url']
+                if not url:
+                    server = self.start_daphne(options['port'])
+                    url = f'ws://127.0.0.1:{options["port"]}'
+                factory = lambda path, headers: SocketClient(url.rstrip('/') + '/' + path, dict(headers))
+                results = asyncio.run(self.run(factory, chats, sessions, options))
+                results['rss_kb'] = current_rss_kb(server.pid) if server else None
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+            self.delete_fixtures(run_id, chats)
+
+        results.update({
+            'label': options['label'],
+            'mode': options['mode'],
+            'clients': options['clients'],
+            'chats': options['chats'],
+            'rate': options['rate'],
+            'duration': options['duration'],
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'timestamp': time.time(),
+        })
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(json.dumps(results) + '\n')
+
+    def create_fixtures(self, run_id, clients, chats_count):
+        chats = [Chat.objects.create(name=f'{BENCH_PREFIX}{run_id}:{index}') for index in range(chats_count)]
+        sessions = []
+        for index in range(clients):
+            user = User.objects.create(username=f'bench_{run_id}_{index}', email=f'bench_{run_id}_{index}@bench.local',
+                                       password=make_password(None))
+            chat = chats[index % chats_count]
+            chat.users.add(user)
+
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            sessions.append((chat.id, session.session_key))
+        return chats, sessions
+
+    def delete_fixtures(self, run_id, chats):
+        User.objects.filter(username__startswith=f'bench_{run_id}_').delete()
+        Chat.objects.filter(id__in=[chat.id for chat in chats]).delete()
+
+    def start_daphne(self, port):
+        server = subprocess.Popen([sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port),
+                                   'msg.asgi:application'], cwd=settings.BASE_DIR,
+                                  env={**os.environ, 'RATELIMIT_ENABLED': 'False'},
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return server
+            except OSError:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('Daphne did not start.')
+
+    async def run(self, factory, chats, sessions, options):
+        headers = lambda session_key: [
+            (b'origin', b'http://localhost'),
+            (b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode()),
+        ]
+        clients = [factory(f'chat/{chat_id}/', headers(session_key)) for chat_id, session_key in sessions]
+        connected = await asyncio.gather(*(client.connect() for client in clients))
+        if not all(connected):
+            raise CommandError(f'{connected.count(False)} clients failed to connect.')
+
+        latencies = []
+        errors = Counter()
+        sent = 0
+        stop_receiving = False
+
+        async def receive(client):
+            while not stop_receiving:
+                frame = await client.receive(timeout=0.5)
+                if frame is None:
+                    continue
+                data = json.loads(frame)
+                if data.get('type') == 'error':
+                    errors[data['error']] += 1
+                    continue
+                text = data.get('text') or ''
+                if text.startswith(BENCH_PREFIX):
+                    latencies.append(time.perf_counter_ns() - int(text.rsplit(':', 1)[1]))
+
+        async def publish(client, index):
+            nonlocal sent
+            interval = len(clients) / options['rate']
+            await asyncio.sleep(random.uniform(0, interval))
+            deadline = time.perf_counter() + options['duration']
+            sequence = 0
+            while time.perf_counter() < deadline:
+                await client.send(json.dumps({'text': f'{BENCH_PREFIX}{index}:{sequence}:{time.perf_counter_ns()}'}))
+                sent += 1
+                sequence += 1
+                await asyncio.sleep(interval)
+
+        receivers = [asyncio.create_task(receive(client)) for client in clients]
+        started = time.perf_counter()
+        await asyncio.gather(*(publish(client, index) for index, client in enumerate(clients)))
+        await asyncio.sleep(options['drain'])
+        elapsed = time.perf_counter() - started
+        stop_receiving = True
+        await asyncio.gather(*receivers)
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+        members = len(clients) / len(chats)
+        latencies.sort()
+        return {
+            'sent': sent,
+            'delivered': len(latencies),
+            'expected_deliveries': round(sent * members),
+            'errors': dict(errors),
+            'sent_per_second': sent / options['duration'],
+            'delivered_per_second': len(latencies) / elapsed,
+            'latency_ms': {
+                name: percentile(latencies, percent) / 1e6 if latencies else None
+                for name, percent in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+            },
+        }
+
+    def report(self, results):
+        latency = results['latency_ms']
+        self.stdout.write(f'{results["label"] or results["mode"]}: {results["clients"]} clients in '
+                          f'{results["chats"]} chats, {results["sent"]} sent, {results["delivered"]}/'
+                          f'{results["expected_deliveries"]} delivered')
+        errors = ', '.join(f'{count} {error}' for error, count in results['errors'].items())
+        self.stdout.write(f'  error frames: {sum(results["errors"].values())}' + (f' ({errors})' if errors else ''))
+        self.stdout.write(f'  throughput: {results["sent_per_second"]:.1f} msg/s sent, '
+                          f'{results["delivered_per_second"]:.1f} deliveries/s')
+        if latency['p50'] is not None:
+            self.stdout.write(f'  latency: p50 {latency["p50"]:.2f} ms, p95 {latency["p95"]:.2f} ms, '
+                              f'p99 {latency["p99"]:.2f} ms, max {latency["max"]:.2f} ms')
+        self.stdout.write(f'  rss: {results["rss_kb"]} KB, peak (benchmark process): {results["peak_rss_kb"]} KB')
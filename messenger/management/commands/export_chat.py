@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger.export import EXPORT_FORMATS, export_chat_history
+from messenger.models import Chat
+
+
+class Command(BaseCommand):
+    help = 'Streams the full history of a chat as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_id', type=int)
+        parser.add_argument('--format', choices=tuple(EXPORT_FORMATS), default='ndjson', dest='export_format')
+        parser.add_argument('--output', help='Output file (stdout by default).')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            chat = Chat.objects.get(id=options['chat_id'])
+        except Chat.DoesNotExist:
+            raise CommandError('This chat does not exist.')
+
+        lines = export_chat_history(chat, options['export_format'], chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
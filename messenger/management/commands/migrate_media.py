@@ -0,0 +1,81 @@
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from messenger.models import Chat, DocumentTemplate, Group, Message, Profile
+
+
+MEDIA_FIELDS = (
+    (Profile, 'photo'),
+    (Chat, 'photo'),
+    (Message, 'file'),
+    (Group, 'methodological_guide'),
+    (DocumentTemplate, 'template_file'),
+)
+LEGACY_PREFIX = 'static/'
+
+
+class Command(BaseCommand):
+    help = 'Moves uploads stored under static/ into the media storage and rewrites the file fields in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source-root', default=settings.BASE_DIR,
+                            help='Directory the legacy names are relative to (the project directory by default).')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--keep-source', action='store_true', help='Copy the files instead of moving them.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved.')
+
+    def handle(self, *args, **options):
+        total_moved = total_missing = 0
+        # Sources are removed once every row was rewritten, as several rows may share a file
+        sources = set()
+        for model, field_name in MEDIA_FIELDS:
+            moved, missing = self.migrate_field(model, field_name, sources, options)
+            total_moved += moved
+            total_missing += missing
+            if moved or missing:
+                self.stdout.write(f'{model.__name__}.{field_name}: {moved} moved, {missing} missing')
+
+        if not options['keep_source']:
+            for source in sources:
+                os.remove(source)
+
+        action = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{action} {total_moved} files, {total_missing} missing'))
+
+    def migrate_field(self, model, field_name, sources, options):
+        field = model._meta.get_field(field_name)
+        queryset = model.objects.filter(**{f'{field_name}__startswith': LEGACY_PREFIX}).only('pk', field_name)
+
+        moved = missing = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:options['batch_size']])
+            if not batch:
+                return moved, missing
+            last_pk = batch[-1].pk
+
+            updated = []
+            for instance in batch:
+                source = os.path.join(options['source_root'], getattr(instance, field_name).name)
+                if not os.path.isfile(source):
+                    missing += 1
+                    continue
+                moved += 1
+                if options['dry_run']:
+                    continue
+
+                name = field.generate_filename(instance, os.path.basename(source))
+                with open(source, 'rb') as file:
+                    name = field.storage.save(name, File(file), max_length=field.max_length)
+                setattr(instance, field.attname, name)
+                updated.append(instance)
+                sources.add(source)
+
+            if updated:
+                model.objects.bulk_update(updated, [field_name])
@@ -0,0 +1,29 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from messenger.membership import reconcile_diploma_chats
+
+
+class Command(BaseCommand):
+    help = 'Makes every student a member of their group\'s diploma chat and removes those who left the group.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, action='append', dest='groups',
+                            help='Only reconcile the diploma chat of the given group id. Can be repeated.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift.')
+
+    def handle(self, *args, **options):
+        drift = reconcile_diploma_chats(groups=options['groups'], dry_run=options['dry_run'],
+                                        batch_size=options['batch_size'])
+
+        added, removed = Counter(chat_id for _, chat_id in drift.added), Counter(chat_id for _, chat_id in drift.removed)
+        for chat_id in sorted(added.keys() | removed.keys()):
+            self.stdout.write(f'Chat {chat_id}: {added[chat_id]} added, {removed[chat_id]} removed')
+
+        action = 'Would fix' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {len(drift.added)} missing and {len(drift.removed)} stale memberships, '
+            f'created {drift.created_chats} diploma chats'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from messenger.digests import collect_digests, send_digests
+
+
+class Command(BaseCommand):
+    help = 'Emails every user a digest of the messages they received since their last digest. Run it periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Digests whose recipients are marked as sent at once '
+                                 '(EMAIL_DIGEST_BATCH_SIZE by default).')
+        parser.add_argument('--dry-run', action='store_true', help='Only report who would get a digest.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            digests = collect_digests()
+            for chats in digests.values():
+                self.stdout.write(f'{chats[0]["user__email"]}: {sum(chat["unread"] for chat in chats)} unread')
+            self.stdout.write(self.style.SUCCESS(f'Would send {len(digests)} digests'))
+            return
+
+        sent = send_digests(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Sent {sent} digests'))
@@ -0,0 +1,124 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .conditional import bump_chat_versions
+from .models import Chat, Group, Profile
+
+
+# Row kinds of the membership query
+DESIRED, CURRENT, PROTECTED = 0, 1, 2
+
+Membership = Chat.users.through
+
+
+class MembershipDrift:
+    """Differences between the diploma chat members and the students of their groups, as (user_id, chat_id)."""
+
+    def __init__(self, created_chats=0, added=(), removed=()):
+        self.created_chats = created_chats
+        self.added = list(added)
+        self.removed = list(removed)
+
+    def __bool__(self):
+        return bool(self.created_chats or self.added or self.removed)
+
+
+def ensure_diploma_chats(groups=None, users=None):
+    """Creates the missing diploma chats of `groups` or of the groups of `users` (every group by default).
+
+    Returns how many chats were created.
+    """
+    missing = Group.objects.exclude(chat__type=Chat.ChatTypes.DIPLOMA)
+    if groups is not None:
+        missing = missing.filter(pk__in=[getattr(group, 'pk', group) for group in groups])
+    if users is not None:
+        missing = missing.filter(profile__user__in=[getattr(user, 'pk', user) for user in users])
+    chats = Chat.objects.bulk_create([
+        Chat(name=f'Дипломний чат {group.name}', type=Chat.ChatTypes.DIPLOMA, group=group)
+        for group in missing.only('pk', 'name')
+    ])
+    return len(chats)
+
+
+def membership_rows(groups=None, users=None):
+    """Yields (user_id, chat_id, kind) for every desired and current diploma chat membership, in one query.
+
+    Every student belongs to the diploma chat of their group. Current members who are teachers, staff or the chat's
+    creator were added on purpose and are reported as PROTECTED, so they are never removed.
+    """
+    desired = Profile.objects.filter(group__chat__type=Chat.ChatTypes.DIPLOMA).annotate(
+        member=F('user_id'), diploma_chat=F('group__chat__id'), kind=Value(DESIRED, output_field=IntegerField()),
+    )
+    protected = Q(user__profile__is_teacher=True) | Q(user__is_staff=True) | Q(user_id=F('chat__creator_id'))
+    current = Membership.objects.filter(chat__type=Chat.ChatTypes.DIPLOMA).annotate(
+        member=F('user_id'), diploma_chat=F('chat_id'),
+        kind=Case(When(protected, then=Value(PROTECTED)), default=Value(CURRENT), output_field=IntegerField()),
+    )
+    if groups is not None:
+        group_ids = [getattr(group, 'pk', group) for group in groups]
+        desired = desired.filter(group_id__in=group_ids)
+        current = current.filter(chat__group_id__in=group_ids)
+    if users is not None:
+        user_ids = [getattr(user, 'pk', user) for user in users]
+        desired = desired.filter(user_id__in=user_ids)
+        current = current.filter(user_id__in=user_ids)
+
+    fields = ('member', 'diploma_chat', 'kind')
+    return desired.values_list(*fields).union(current.values_list(*fields), all=True)
+
+
+@transaction.atomic
+def reconcile_diploma_chats(groups=None, users=None, dry_run=False, batch_size=500):
+    """Brings diploma chat membership in line with Profile.group and returns the drift that was fixed.
+
+    The whole membership is read with one query and the differences are applied with bulk inserts into and deletes
+    from the membership table. `groups` and `users` limit the reconciliation to their chats and members.
+    """
+    created_chats = 0 if dry_run else ensure_diploma_chats(groups, users)
+
+    desired, current = set(), {}
+    for user_id, chat_id, kind in membership_rows(groups, users):
+        if kind == DESIRED:
+            desired.add((user_id, chat_id))
+        else:
+            current[user_id, chat_id] = kind == PROTECTED
+
+    drift = MembershipDrift(
+        created_chats,
+        added=sorted(desired - current.keys()),
+        removed=sorted(pair for pair, protected in current.items() if not protected and pair not in desired),
+    )
+    if dry_run:
+        return drift
+
+    Membership.objects.bulk_create([Membership(user_id=user_id, chat_id=chat_id) for user_id, chat_id in drift.added],
+                                   batch_size=batch_size, ignore_conflicts=True)
+    for start in range(0, len(drift.removed), batch_size):
+        removed_by_chat = defaultdict(list)
+        for user_id, chat_id in drift.removed[start:start + batch_size]:
+            removed_by_chat[chat_id].append(user_id)
+        condition = Q()
+        for chat_id, user_ids in removed_by_chat.items():
+            condition |= Q(chat_id=chat_id, user_id__in=user_ids)
+        Membership.objects.filter(condition).delete()
+    # Bulk writes on the membership table send no m2m_changed signals
+    bump_chat_versions({chat_id for _, chat_id in drift.added + drift.removed})
+    return drift
+
+
+@receiver(post_save, sender=Group)
+def reconcile_group_chat(sender, instance, raw=False, **kwargs):
+    if not raw:
+        reconcile_diploma_chats(groups=[instance])
+
+
+@receiver(post_save, sender=Profile)
+def reconcile_profile_chats(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (created and instance.group_id is None):
+        return
+    if update_fields is None or {'group', 'group_id', 'is_teacher'} & set(update_fields):
+        reconcile_diploma_chats(users=[instance.user_id])
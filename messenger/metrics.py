@@ -0,0 +1,182 @@
+import threading
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+REGISTRY = []
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        with self._lock:
+            children = list(self._children.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, child in children:
+            lines.extend(self._samples(values, child))
+        return lines
+
+    def _samples(self, values, child):
+        return [f'{self.name}{format_labels(self.labelnames, values)} {format_value(child.value)}']
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class GaugeChild(CounterChild):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = format_labels(self.labelnames, values, (('le', format_value(float(bound))),))
+            samples.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labelnames, values)
+        samples.append(f'{self.name}_sum{labels} {format_value(total)}')
+        samples.append(f'{self.name}_count{labels} {cumulative}')
+        return samples
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+http_requests = Counter('messenger_http_requests_total', 'HTTP requests by route and status code.',
+                        ('route', 'method', 'status'))
+http_request_duration = Histogram('messenger_http_request_duration_seconds', 'Wall time of HTTP requests.',
+                                  ('route', 'method'))
+http_db_queries = Histogram('messenger_http_db_queries', 'SQL queries executed per HTTP request.',
+                            ('route', 'method'), buckets=COUNT_BUCKETS)
+http_db_duration = Histogram('messenger_http_db_duration_seconds', 'Time spent in SQL per HTTP request.',
+                             ('route', 'method'))
+
+ws_connections = Gauge('messenger_ws_connections', 'Open WebSocket connections of this worker.')
+ws_connects = Counter('messenger_ws_connects_total', 'Accepted WebSocket connections.')
+ws_disconnects = Counter('messenger_ws_disconnects_total', 'Closed WebSocket connections.')
+ws_group_members = Gauge('messenger_ws_group_members', 'Sockets of this worker joined to a chat group.', ('group',))
+ws_frames_received = Counter('messenger_ws_frames_received_total', 'Inbound WebSocket frames.')
+ws_group_send_duration = Histogram('messenger_ws_group_send_duration_seconds',
+                                   'Duration of channel layer group_send.')
+ws_delivery_delay = Histogram('messenger_ws_delivery_delay_seconds',
+                              'Delay between publishing a chat event and sending it to a socket.')
+
+ratelimit_rejections = Counter('messenger_ratelimit_rejections_total',
+                               'Messages rejected by rate limits and admission control.', ('scope',))
+
+email_digests_sent = Counter('messenger_email_digests_sent_total', 'Digest emails accepted by the SMTP server.')
+email_digest_failures = Counter('messenger_email_digest_failures_total', 'Digest emails that could not be sent.')
+email_digest_batch_duration = Histogram('messenger_email_digest_batch_duration_seconds',
+                                        'Time to render and send one batch of digest emails.')
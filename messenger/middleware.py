@@ -0,0 +1,87 @@
+from time import perf_counter
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+
+from . import metrics
+from .authentication import aget_cached_user, read_ws_ticket
+
+
+class QueryTracker:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += perf_counter() - started
+            self.count += 1
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    view_class = getattr(match.func, 'cls', None) or getattr(match.func, 'view_class', None)
+    if view_class is None:
+        return match.view_name or match.func.__name__
+    actions = getattr(match.func, 'actions', None)
+    if actions:
+        return f'{view_class.__name__}.{actions.get(request.method.lower(), request.method.lower())}'
+    return f'{view_class.__name__}.{request.method.lower()}'
+
+
+class RequestMetricsMiddleware:
+    """Records wall time, SQL query count and SQL time of every resolved request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'METRICS_ENABLED', True)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        tracker = QueryTracker()
+        started = perf_counter()
+        with connection.execute_wrapper(tracker):
+            response = self.get_response(request)
+        duration = perf_counter() - started
+
+        route = route_name(request)
+        if route is None:
+            return response
+        metrics.http_requests.labels(route, request.method, str(response.status_code)).inc()
+        metrics.http_request_duration.labels(route, request.method).observe(duration)
+        metrics.http_db_queries.labels(route, request.method).observe(tracker.count)
+        metrics.http_db_duration.labels(route, request.method).observe(tracker.duration)
+        return response
+
+
+class TicketAuthMiddleware:
+    """Authenticates WebSocket connections from a signed `?ticket=` issued by /api/ws_ticket.
+
+    The ticket carries the user id, so together with the user cache a connect needs no session or user query.
+    Connections without a ticket fall back to the session based AuthMiddlewareStack.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        ticket = parse_qs(scope.get('query_string', b'').decode()).get('ticket')
+        if not ticket:
+            return await self.session_auth(scope, receive, send)
+
+        user_id = read_ws_ticket(ticket[0])
+        user = await aget_cached_user(user_id) if user_id is not None else None
+        if user is None or not user.is_active:
+            user = AnonymousUser()
+        return await self.inner(dict(scope, user=user), receive, send)
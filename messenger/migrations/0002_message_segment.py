@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_number', models.PositiveIntegerField(verbose_name='Перший номер')),
+                ('last_number', models.PositiveIntegerField(verbose_name='Останній номер')),
+                ('count', models.PositiveIntegerField(verbose_name='Кількість повідомлень')),
+                ('path', models.CharField(max_length=255, unique=True, verbose_name='Файл сегменту')),
+                ('codec', models.CharField(choices=[('gzip', 'gzip'), ('zstd', 'zstd')], default='gzip', max_length=16, verbose_name='Стиснення')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Дата архівації')),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='messenger.chat', verbose_name='Чат')),
+            ],
+            options={
+                'verbose_name': 'Архівний сегмент',
+                'verbose_name_plural': 'Архівні сегменти',
+                'indexes': [models.Index(fields=['chat', 'last_number'], name='messenger_segment_range_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0002_message_segment'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('pinned', True)), fields=['chat', 'number'], name='messenger_message_pinned_idx'),
+        ),
+    ]
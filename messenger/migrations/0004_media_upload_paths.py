@@ -0,0 +1,38 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0003_message_pinned_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='photo',
+            field=models.ImageField(blank=True, null=True, upload_to='messenger/chat_photos', verbose_name='Фото'),
+        ),
+        migrations.AlterField(
+            model_name='documenttemplate',
+            name='template_file',
+            field=models.FileField(upload_to='messenger/document_templates', verbose_name='Файл шаблону'),
+        ),
+        migrations.AlterField(
+            model_name='group',
+            name='methodological_guide',
+            field=models.FileField(blank=True, upload_to='messenger/methodological_guides', verbose_name='Методичні вказівки'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, null=True, upload_to='messenger/message_files', verbose_name='Файл'),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='photo',
+            field=models.ImageField(blank=True, upload_to='messenger/profile_photos', verbose_name='Фото'),
+        ),
+    ]
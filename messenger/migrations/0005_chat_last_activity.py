@@ -0,0 +1,34 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:47
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def backfill_last_activity(apps, schema_editor):
+    Chat = apps.get_model('messenger', 'Chat')
+    Message = apps.get_model('messenger', 'Message')
+    # The newest message of a chat is never archived, so the hot table has every chat's latest timestamp
+    latest = Message.objects.filter(chat=OuterRef('pk')).values('chat').annotate(latest=Max('timestamp')).values('latest')
+    Chat.objects.update(last_activity=Coalesce(Subquery(latest), 'last_activity'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0004_media_upload_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Остання активність'),
+        ),
+        migrations.RunPython(backfill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['-last_activity', '-id'], name='messenger_chat_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0005_chat_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='file_height',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Висота зображення'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='file_width',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Ширина зображення'),
+        ),
+    ]
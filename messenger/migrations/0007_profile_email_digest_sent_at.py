@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-19 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0006_message_image_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='email_digest_sent_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Останній дайджест'),
+        ),
+    ]
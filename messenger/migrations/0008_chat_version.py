@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-19 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0007_profile_email_digest_sent_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версія'),
+        ),
+    ]
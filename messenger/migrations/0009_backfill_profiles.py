@@ -0,0 +1,25 @@
+# Generated by Django 4.2.1 on 2026-10-19 14:10
+
+from django.db import migrations
+
+
+def backfill_profiles(apps, schema_editor):
+    # update_user_profile only saves a profile loaded along with the user, users created without one are given one
+    User = apps.get_model('auth', 'User')
+    Profile = apps.get_model('messenger', 'Profile')
+    Profile.objects.bulk_create(
+        [Profile(user_id=user_id) for user_id in User.objects.filter(profile__isnull=True).values_list('id', flat=True)],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('messenger', '0008_chat_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_profiles, migrations.RunPython.noop),
+    ]
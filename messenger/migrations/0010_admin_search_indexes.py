@@ -0,0 +1,37 @@
+# Generated by Django 4.2.1 on 2026-10-19 18:05
+
+from django.db import migrations
+
+
+# The admin's prefix search (`^name`) compiles to UPPER(column) LIKE 'PREFIX%', which only an index on the same
+# expression with pattern operators can serve. PostgreSQL only: SQLite never uses an index for that LIKE.
+SEARCH_INDEXES = (
+    ('messenger_chat_name_upper_idx', 'messenger_chat', 'name'),
+    ('messenger_user_username_upper_idx', 'auth_user', 'username'),
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} (UPPER({column}) text_pattern_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in SEARCH_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('messenger', '0009_backfill_profiles'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
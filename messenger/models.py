@@ -1,16 +1,18 @@
-from urllib.request import urlopen
-from os.path import basename
+import os
+import uuid
 
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
-from django.core.files.temp import NamedTemporaryFile
-from django.core.files import File
+from django.core.files.base import ContentFile
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import UserManager
 
+from .thumbnails import read_image_size
+
 
 def new_create_superuser(self, email=None, password=None, **extra_fields):
         extra_fields.setdefault("is_staff", True)
@@ -48,6 +50,50 @@ User._meta.verbose_name = 'Користувач'
 User._meta.verbose_name_plural = 'Користувачі'
 
 
+class TrackedFieldsMixin:
+    """Saves only the fields changed since the instance was loaded and skips saves that change nothing."""
+
+    def _tracked_values(self):
+        values = {}
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname in deferred:
+                continue
+            value = getattr(self, field.attname)
+            values[field.attname] = value.name if isinstance(field, models.FileField) else value
+        return values
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance._tracked_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        self._loaded_values = self._tracked_values()
+
+    def get_dirty_fields(self):
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return None
+        return [name for name, value in self._tracked_values().items() if loaded.get(name) != value]
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            dirty_fields = self.get_dirty_fields()
+            if dirty_fields is not None:
+                if not dirty_fields:
+                    return
+                update_fields = dirty_fields
+        super().save(force_insert, force_update, using, update_fields)
+        self._loaded_values = self._tracked_values()
+
+
+# auth.User cannot be redeclared with the mixin, so like the patches above it is put in front of the existing bases
+User.__bases__ = (TrackedFieldsMixin,) + User.__bases__
+
+
 class Group(models.Model):
     class DegreeChoices(models.TextChoices):
         BACHELOR = 'bachelor', _('бакалавр')
@@ -64,7 +110,7 @@ class Group(models.Model):
 
     information = models.TextField(blank=True, verbose_name='Посилання', help_text='''Заповнювати у форматі:
 Посилання: https://www.google.com.ua/''')
-    methodological_guide = models.FileField(upload_to='static/messenger/methodological_guides', blank=True,
+    methodological_guide = models.FileField(upload_to='messenger/methodological_guides', blank=True,
                                             verbose_name='Методичні вказівки')
 
     def __str__(self):
@@ -79,25 +125,17 @@ class Group(models.Model):
     ):
         if not self.code:
             self.code = self.name
-
-        group_chat = Chat.objects.filter(Chat.ChatTypes.DIPLOMA, group=self)
-        if not group_chat:
-            group_chat = Chat.objects.create(name=f'Дипломний чат {self.name}', type=Chat.ChatTypes.DIPLOMA,
-                                             group=self)
-            group_users = Profile.objects.filter(group=self)
-            for user in group_users:
-                group_chat.users.add(user.user)
-            group_chat.save()
+        # The diploma chat is created and filled by messenger.membership once the group is saved
         super().save(force_insert, force_update, using, update_fields)
 
     def get_degree(self):
         return self.DegreeChoices(self.degree).label
 
 
-class Profile(models.Model):
+class Profile(TrackedFieldsMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, verbose_name='Користувач')
     bio = models.TextField(max_length=500, blank=True, verbose_name='Про себе')
-    photo = models.ImageField(upload_to='static/messenger/profile_photos', blank=True, verbose_name='Фото')
+    photo = models.ImageField(upload_to='messenger/profile_photos', blank=True, verbose_name='Фото')
     email_confirmed = models.BooleanField(default=False, verbose_name='Підтвердження пошти')
     group = models.ForeignKey(Group, on_delete=models.CASCADE, blank=True, null=True, verbose_name='Група')
     is_teacher = models.BooleanField(default=False, verbose_name='Є викладачем')
@@ -108,6 +146,7 @@ class Profile(models.Model):
     diploma_topic = models.CharField(max_length=255, blank=True, verbose_name='Тема диплому')
     diploma_reviewer = models.CharField(max_length=255, blank=True, verbose_name='Рецензент')
     diploma_reviewer_position = models.CharField(max_length=255, blank=True, verbose_name='Посада рецензента')
+    email_digest_sent_at = models.DateTimeField(blank=True, null=True, verbose_name='Останній дайджест')
 
     def __str__(self):
         return f'{self.user.first_name} {self.user.last_name} {self.user.email}'
@@ -120,25 +159,22 @@ class Profile(models.Model):
         return self.user.email
 
     def get_photo_from_url(self, url):
-        photo_tmp = NamedTemporaryFile()
-        with urlopen(url) as uo:
-            assert uo.status == 200
-            photo_tmp.write(uo.read())
-            photo_tmp.flush()
-        photo = File(photo_tmp)
-        file_name = basename(photo_tmp.name) + '.jpg'
-        self.photo.save(basename(file_name), photo)
-        photo_tmp.close()
+        from .oauth import download
+
+        self.photo.save(f'{uuid.uuid4().hex}.jpg', ContentFile(download(url)))
 
 
 @receiver(post_save, sender=User)
 def update_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
-    try:
-        instance.profile.save()
-    except ObjectDoesNotExist:
-        Profile.objects.create(user=instance)
+        return
+    # Only a profile loaded along with the user can have pending changes, a clean one is not written
+    if User.profile.is_cached(instance):
+        try:
+            instance.profile.save()
+        except ObjectDoesNotExist:
+            Profile.objects.create(user=instance)
 
 
 class Chat(models.Model):
@@ -149,10 +185,13 @@ class Chat(models.Model):
 
     name = models.CharField(max_length=255, verbose_name='Назва чату')
     users = models.ManyToManyField(User, related_name='chats', verbose_name='Користувачі')
-    photo = models.ImageField(upload_to='static/messenger/chat_photos', blank=True, null=True, verbose_name='Фото')
+    photo = models.ImageField(upload_to='messenger/chat_photos', blank=True, null=True, verbose_name='Фото')
     type = models.CharField(max_length=255, choices=ChatTypes.choices, default=ChatTypes.GROUP, verbose_name='Тип чату')
     creator = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True, verbose_name='Творець чату')
     group = models.ForeignKey(Group, on_delete=models.CASCADE, blank=True, null=True, verbose_name='Група')
+    last_activity = models.DateTimeField(default=timezone.now, verbose_name='Остання активність')
+    # Bumped by messenger.conditional on changes that do not move last_activity, e.g. renames and new members
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name='Версія')
 
     def __str__(self):
         return str(f'Чат {self.name} {self.ChatTypes(self.type).label}')
@@ -160,6 +199,9 @@ class Chat(models.Model):
     class Meta:
         verbose_name = 'Чат'
         verbose_name_plural = 'Чати'
+        indexes = [
+            models.Index(fields=['-last_activity', '-id'], name='messenger_chat_activity_idx'),
+        ]
 
     def is_user_in_chat(self, user):
         return self.users.filter(id=user.id).exists()
@@ -177,29 +219,81 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, verbose_name='Чат')
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='Користувач')
     text = models.TextField(verbose_name='Текст повідомлення')
-    file = models.FileField(upload_to='static/messenger/message_files', blank=True, null=True, verbose_name='Файл')
+    file = models.FileField(upload_to='messenger/message_files', blank=True, null=True, verbose_name='Файл')
+    file_width = models.PositiveIntegerField(blank=True, null=True, verbose_name='Ширина зображення')
+    file_height = models.PositiveIntegerField(blank=True, null=True, verbose_name='Висота зображення')
     number = models.PositiveIntegerField(default=0, verbose_name='Номер повідомлення')
     timestamp = models.DateTimeField(auto_now_add=True, verbose_name='Дата надсилання')
     pinned = models.BooleanField(default=False, verbose_name='Закріплено')
 
+    # Set on messages read back from an archived segment, which no longer have a row
+    archived = False
+
     class Meta:
         verbose_name = 'Повідомлення'
         verbose_name_plural = 'Повідомлення'
 
         unique_together = ("chat", "number")
+        indexes = [
+            models.Index(fields=['chat', 'number'], condition=models.Q(pinned=True),
+                         name='messenger_message_pinned_idx'),
+            # Serves the range of each chat's messages read by the email digests
+            models.Index(fields=['chat', 'timestamp'], name='messenger_message_time_idx'),
+        ]
 
     def __str__(self):
         return f'{self.chat} {self.user} {self.number}'
 
     def save(self, *args, **kwargs):
-        if not self.pk:
+        created = not self.pk
+        if created:
             number = calc_msg_number(self.chat)
             self.number = number
+            if self.file and self.file_width is None:
+                # Clients lay out image attachments from these before downloading any of them
+                self.file_width, self.file_height = read_image_size(self.file) or (None, None)
         super(Message, self).save(*args, **kwargs)
+        if created:
+            Chat.objects.filter(pk=self.chat_id, last_activity__lt=self.timestamp).update(last_activity=self.timestamp)
+
+
+class MessageSegment(models.Model):
+    class Codecs(models.TextChoices):
+        GZIP = 'gzip', 'gzip'
+        ZSTD = 'zstd', 'zstd'
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='segments', verbose_name='Чат')
+    first_number = models.PositiveIntegerField(verbose_name='Перший номер')
+    last_number = models.PositiveIntegerField(verbose_name='Останній номер')
+    count = models.PositiveIntegerField(verbose_name='Кількість повідомлень')
+    path = models.CharField(max_length=255, unique=True, verbose_name='Файл сегменту')
+    codec = models.CharField(max_length=16, choices=Codecs.choices, default=Codecs.GZIP, verbose_name='Стиснення')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Дата архівації')
+
+    class Meta:
+        verbose_name = 'Архівний сегмент'
+        verbose_name_plural = 'Архівні сегменти'
+
+        indexes = [
+            models.Index(fields=['chat', 'last_number'], name='messenger_segment_range_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.chat} {self.first_number}-{self.last_number}'
+
+
+@receiver(post_delete, sender=MessageSegment)
+def delete_segment_file(sender, instance, **kwargs):
+    from .archive import get_archive_root
+
+    try:
+        os.remove(os.path.join(get_archive_root(), instance.path))
+    except FileNotFoundError:
+        pass
 
 
 class DocumentTemplate(models.Model):
-    template_file = models.FileField(upload_to='static/messenger/document_templates', verbose_name='Файл шаблону')
+    template_file = models.FileField(upload_to='messenger/document_templates', verbose_name='Файл шаблону')
     name = models.CharField(max_length=255, verbose_name='Назва шаблону', unique=True)
     button_text = models.CharField(max_length=255, verbose_name='Текст кнопки')
 
@@ -0,0 +1,96 @@
+import threading
+
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+
+
+GOOGLE_ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+JWKS_CACHE_KEY = 'messenger:google_jwks'
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class OAuthError(Exception):
+    pass
+
+
+def get_session():
+    """Returns the process wide HTTP session, so calls to Google reuse pooled keep-alive connections."""
+    global _session
+    if _session is None:
+        # requests is only needed by the OAuth callback, it is loaded on first use to keep worker startup fast
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with _session_lock:
+            if _session is None:
+                # Connection errors are retried for every method, server errors only for idempotent requests,
+                # an authorization code must never be posted twice.
+                retry = Retry(total=settings.GOOGLE_HTTP_RETRIES, backoff_factor=0.2,
+                              status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.GOOGLE_HTTP_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, **kwargs):
+    from requests import RequestException
+
+    try:
+        response = get_session().request(method, url, timeout=settings.GOOGLE_HTTP_TIMEOUT, **kwargs)
+    except RequestException as error:
+        raise OAuthError(f'Request to {url} failed: {error}') from error
+    if not response.ok:
+        raise OAuthError(f'Request to {url} failed with status {response.status_code}.')
+    return response
+
+
+def exchange_code(code, redirect_uri):
+    response = request('POST', settings.GOOGLE_TOKEN_URL, data={
+        'grant_type': 'authorization_code',
+        'client_id': settings.GOOGLE_OAUTH_CLIENT_ID,
+        'client_secret': settings.GOOGLE_OAUTH_CLIENT_SECRET,
+        'redirect_uri': redirect_uri,
+        'code': code,
+    })
+    return response.json()
+
+
+def get_jwks(refresh=False):
+    jwks = None if refresh else cache.get(JWKS_CACHE_KEY)
+    if jwks is None:
+        jwks = request('GET', settings.GOOGLE_JWKS_URL).json()
+        cache.set(JWKS_CACHE_KEY, jwks, settings.GOOGLE_JWKS_CACHE_TIMEOUT)
+    return jwks
+
+
+def get_signing_key(kid):
+    # Google rotates its keys, an unknown key id refetches the key set once before giving up
+    for refresh in (False, True):
+        for key in jwt.PyJWKSet.from_dict(get_jwks(refresh=refresh)).keys:
+            if key.key_id == kid:
+                return key.key
+    raise OAuthError(f'Unknown signing key {kid}.')
+
+
+def verify_id_token(id_token):
+    """Decodes the claims of a Google ID token, checking its signature, audience, issuer and expiry locally."""
+    try:
+        kid = jwt.get_unverified_header(id_token).get('kid')
+        claims = jwt.decode(id_token, get_signing_key(kid), algorithms=['RS256'],
+                            audience=settings.GOOGLE_OAUTH_CLIENT_ID, issuer=GOOGLE_ISSUERS)
+    except (jwt.InvalidTokenError, jwt.PyJWKError, jwt.PyJWKSetError) as error:
+        raise OAuthError(f'Invalid ID token: {error}') from error
+    if not claims.get('email') or not claims.get('email_verified', True):
+        raise OAuthError('ID token has no verified email.')
+    return claims
+
+
+def download(url):
+    return request('GET', url).content
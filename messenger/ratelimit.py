@@ -0,0 +1,160 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+
+# Checks all buckets before consuming from any of them, so a rejected message costs no tokens.
+# KEYS are the bucket keys, ARGV the current time, the cost and a (rate, burst) pair per key.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local limited = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local available = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(0, now - updated) * rate)
+    if available < cost and (cost - available) / rate > wait then
+        wait = (cost - available) / rate
+        limited = i
+    end
+    tokens[i] = available
+end
+if limited == 0 then
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[1 + i * 2])
+        local burst = tonumber(ARGV[2 + i * 2])
+        redis.call('HSET', key, 'tokens', tokens[i] - cost, 'updated', now)
+        redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000))
+    end
+end
+return {tostring(wait), limited}
+"""
+
+
+class Overloaded(Exception):
+    pass
+
+
+class MemoryStore:
+    """Token buckets of this process, used when no Redis is configured and in tests."""
+
+    max_keys = 10000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, limits, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.buckets) > self.max_keys:
+                self.prune(now, limits)
+
+            wait, limited, tokens = 0, None, []
+            for key, rate, burst in limits:
+                available, updated = self.buckets.get(key, (burst, now))
+                available = min(burst, available + (now - updated) * rate)
+                if available < cost and (cost - available) / rate > wait:
+                    wait, limited = (cost - available) / rate, key
+                tokens.append(available)
+
+            if limited is None:
+                for (key, _, _), available in zip(limits, tokens):
+                    self.buckets[key] = (available - cost, now)
+            return wait, limited
+
+    def prune(self, now, limits):
+        # Buckets idle for longer than the slowest refill are full again and need no state
+        idle = max(burst / rate for _, rate, burst in limits)
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < idle}
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisStore:
+    """Token buckets shared by all workers, updated atomically by a Lua script."""
+
+    def __init__(self, url):
+        import redis
+
+        self.errors = (redis.RedisError,)
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, limits, cost=1):
+        args = [time.time(), cost]
+        for _, rate, burst in limits:
+            args.extend((rate, burst))
+        try:
+            wait, limited = self.script(keys=[key for key, _, _ in limits], args=args)
+        except self.errors:
+            # An unavailable limiter must not take message sending down with it
+            return 0, None
+        return float(wait), limits[limited - 1][0] if limited else None
+
+    def clear(self):
+        pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                url = settings.RATELIMIT_REDIS_URL
+                _store = RedisStore(url) if url else MemoryStore()
+    return _store
+
+
+def check_message_rate(user_id, chat_id):
+    """Takes a token from the user's and the chat's bucket, returns 0 or the seconds to wait before retrying."""
+    if not settings.RATELIMIT_ENABLED:
+        return 0
+    limits = [
+        (f'messenger:ratelimit:{scope}:{value}', *settings.MESSAGE_RATE_LIMITS[scope])
+        for scope, value in (('user', user_id), ('chat', chat_id))
+    ]
+    wait, limited = get_store().consume(limits)
+    if limited is not None and settings.METRICS_ENABLED:
+        metrics.ratelimit_rejections.labels(limited.split(':')[2]).inc()
+    return wait
+
+
+class AdmissionControl:
+    """Bounds the message writes in flight in this process and sheds the rest when the writer is saturated."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        with self.lock:
+            if self.in_flight >= settings.MAX_IN_FLIGHT_WRITES:
+                if settings.METRICS_ENABLED:
+                    metrics.ratelimit_rejections.labels('overload').inc()
+                raise Overloaded()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+write_admission = AdmissionControl()
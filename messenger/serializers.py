@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.urls import reverse
 from rest_framework import serializers
 
 from .models import Chat, Message, Profile, Group, DocumentTemplate
@@ -80,12 +82,10 @@ class EditUserSerializer(serializers.ModelSerializer):
                     setattr(profile, key, value)
                 profile.save()
 
-            if 'first_name' in validated_data:
-                instance.first_name = validated_data.pop('first_name')
-
-            if 'last_name' in validated_data:
-                instance.last_name = validated_data.pop('last_name')
-
+            for field in ('first_name', 'last_name'):
+                if field in validated_data:
+                    setattr(instance, field, validated_data.pop(field))
+            # Only the changed columns are written, a user without changes is not saved at all
             instance.save()
 
         return instance
@@ -134,15 +134,18 @@ class ChatSerializer(serializers.ModelSerializer):
     users = MinimumUserSerializer(many=True, read_only=True)
 
     def get_last_message(self, obj):
-        try:
-            return ChatListMessageSerializer(Message.objects.filter(chat=obj).order_by('-number')[0]).data
-        except IndexError:
+        if hasattr(obj, 'latest_messages'):
+            last_message = obj.latest_messages[0] if obj.latest_messages else None
+        else:
+            last_message = Message.objects.filter(chat=obj).order_by('-number').first()
+        if last_message is None:
             return None
+        return ChatListMessageSerializer(last_message).data
 
     class Meta:
         model = Chat
-        fields = ('id', 'name', 'users', 'photo', 'type', 'creator', 'group', 'last_message')
-        read_only_fields = ('id', 'type', 'creator', 'group', 'last_message')
+        fields = ('id', 'name', 'users', 'photo', 'type', 'creator', 'group', 'last_activity', 'last_message')
+        read_only_fields = ('id', 'type', 'creator', 'group', 'last_activity', 'last_message')
 
 
 class DetailedChatSerializer(serializers.ModelSerializer):
@@ -178,10 +181,23 @@ class ExtendedChatSerializer(ChatSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     timestamp = serializers.DateTimeField(format=message_timestamp_format)
     user = MessageUserSerializer(read_only=True)
+    preview = serializers.SerializerMethodField()
+
+    def get_preview(self, obj):
+        # The thumbnail endpoint only serves messages with a row, archived ones are shown from the file itself
+        if obj.archived or not obj.file or not obj.file_width or not obj.file_height:
+            return None
+        url = reverse('message-thumbnail', args=[obj.id])
+        longest_side = max(obj.file_width, obj.file_height)
+        return {
+            'width': obj.file_width,
+            'height': obj.file_height,
+            'thumbnails': {size: f'{url}?size={size}' for size in settings.THUMBNAIL_SIZES if size < longest_side},
+        }
 
     class Meta:
         model = Message
-        fields = ('id', 'number', 'chat', 'user', 'text', 'file', 'timestamp', 'pinned')
+        fields = ('id', 'number', 'chat', 'user', 'text', 'file', 'timestamp', 'pinned', 'preview')
 
 
 class ChatListMessageSerializer(serializers.ModelSerializer):
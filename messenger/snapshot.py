@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .archive import MessageHistory
+from .models import Message
+from .serializers import MessageSerializer
+
+
+def pinned_messages_cache_key(chat, absolute=False):
+    # Pinning and unpinning bump the chat's version, so a changed list is stored under a new key
+    return f'messenger:pinned_messages:{chat.id}:{chat.version}' + (':absolute' if absolute else '')
+
+
+def get_pinned_messages(chat, request=None):
+    """Serialized pinned messages of a chat, newest first.
+
+    Pinned lists are short and read on every chat open, so they are cached for the current version of the chat.
+    File URLs are absolute when serialized for a `request` and relative in socket frames, each form is cached apart.
+    """
+    key = pinned_messages_cache_key(chat, absolute=request is not None)
+    data = cache.get(key)
+    if data is None:
+        queryset = Message.objects.filter(chat_id=chat.id, pinned=True).select_related('user__profile')
+        data = list(MessageSerializer(queryset.order_by('-number'), many=True, context={'request': request}).data)
+        cache.set(key, data, settings.PINNED_MESSAGES_CACHE_TIMEOUT)
+    return data
+
+
+def build_snapshot(chat, limit):
+    """The first frame of a socket opened with `?snapshot=N`: what a client needs to draw the chat.
+
+    Holds the last `limit` messages newest first (capped at WS_SNAPSHOT_MAX_MESSAGES), the pinned messages and
+    `last_number`, the number of the newest message. The socket joins the chat group before the snapshot is read, so
+    no message is lost in between; broadcasts numbered up to `last_number` are already part of the snapshot.
+    """
+    limit = min(limit, settings.WS_SNAPSHOT_MAX_MESSAGES)
+    queryset = Message.objects.filter(chat_id=chat.id).select_related('user__profile').order_by('-number')
+    messages = MessageSerializer(MessageHistory.for_queryset(queryset, chat.id)[:limit], many=True).data
+    return {
+        'type': 'snapshot',
+        'messages': messages,
+        'pinned': get_pinned_messages(chat),
+        'last_number': messages[0]['number'] if messages else None,
+    }
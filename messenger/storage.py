@@ -0,0 +1,66 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.move import file_move_safe
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """Media storage that spreads uploads over hash-prefixed directories and writes them atomically.
+
+    `messenger/profile_photos/me.jpg` is stored as e.g. `messenger/profile_photos/3f/a2/me.jpg`, which keeps every
+    directory small however many files are uploaded. Files are written to a temporary file next to their destination
+    and linked into place once complete, so readers never see a partial upload.
+    """
+
+    def __init__(self, *args, shard_depth=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_depth = settings.MEDIA_SHARD_DEPTH if shard_depth is None else shard_depth
+
+    def shard(self, filename):
+        digest = hashlib.sha1(f'{filename}:{uuid.uuid4().hex}'.encode()).hexdigest()
+        return [digest[index * 2:index * 2 + 2] for index in range(self.shard_depth)]
+
+    def generate_filename(self, filename):
+        filename = super().generate_filename(filename)
+        dirname, basename = posixpath.split(filename)
+        return posixpath.join(dirname, *self.shard(basename), basename)
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(directory, self.directory_permissions_mode)
+
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            if hasattr(content, 'temporary_file_path'):
+                os.close(descriptor)
+                file_move_safe(content.temporary_file_path(), temp_path, allow_overwrite=True)
+            else:
+                with os.fdopen(descriptor, 'wb') as file:
+                    for chunk in content.chunks():
+                        file.write(chunk)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            # link() fails instead of replacing a file that appeared since the name was chosen
+            while True:
+                try:
+                    os.link(temp_path, full_path)
+                    break
+                except FileExistsError:
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+        finally:
+            os.unlink(temp_path)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        self._ensure_location_group_id(full_path)
+        return os.path.relpath(full_path, self.location).replace('\\', '/')
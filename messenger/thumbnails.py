@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+from concurrent import futures
+
+from django.conf import settings
+
+
+EXIF_ORIENTATION = 0x0112
+# Orientations that rotate the image by 90 degrees, so its displayed width and height are swapped
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+class ThumbnailUnavailable(Exception):
+    pass
+
+
+class ThumbnailCache:
+    """Thumbnails of image attachments, rendered on first request and kept on disk up to `max_bytes`.
+
+    Rendering runs in a small thread pool, which bounds how many images are decoded at once, and concurrent
+    requests for the same thumbnail share one rendering. A cache hit refreshes the file's mtime, so when the cache
+    outgrows its cap the least recently used thumbnails are evicted first.
+    """
+
+    def __init__(self, root, max_bytes, workers):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.total_bytes = None
+
+    def path(self, name, size):
+        digest = hashlib.sha1(f'{name}:{size}'.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], f'{digest}.jpg')
+
+    def get(self, file, size):
+        """Returns the `size` pixel thumbnail of `file` opened for reading and the original's dimensions.
+
+        The thumbnail is opened before returning, so eviction cannot remove it from under the caller. Raises
+        ThumbnailError for files that are not images or too large to decode, and ThumbnailUnavailable when the
+        rendering does not finish within THUMBNAIL_TIMEOUT.
+        """
+        path = self.path(file.name, size)
+        try:
+            thumbnail = open(path, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            return thumbnail, None
+
+        with self.lock:
+            future = self.pending.get(path)
+            submitted = future is None
+            if submitted:
+                future = self.pending[path] = self.executor.submit(self.render, file, size, path)
+        if submitted:
+            # Outside the lock, a callback of an already finished future runs right away in this thread
+            future.add_done_callback(lambda _: self.forget(path))
+        try:
+            dimensions = future.result(timeout=settings.THUMBNAIL_TIMEOUT)
+        except futures.TimeoutError:
+            # The rendering goes on and serves a later request
+            raise ThumbnailUnavailable(f'Rendering took longer than {settings.THUMBNAIL_TIMEOUT} seconds.')
+        try:
+            return open(path, 'rb'), dimensions
+        except FileNotFoundError:
+            raise ThumbnailUnavailable('The thumbnail was evicted before it could be read.')
+
+    def forget(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+
+    def render(self, file, size, path):
+        from PIL import Image, ImageOps, UnidentifiedImageError
+
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with file.open('rb'), Image.open(file) as image:
+                image = ImageOps.exif_transpose(image)
+                dimensions = image.size
+                image.thumbnail((size, size))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                image.save(temp_path, 'JPEG', quality=80, optimize=True)
+            os.replace(temp_path, path)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise ThumbnailError(str(error)) from error
+
+        self.account(os.path.getsize(path))
+        return dimensions
+
+    def account(self, added):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(os.path.getsize(path) for path, _ in self.files())
+            else:
+                self.total_bytes += added
+            over_cap = self.total_bytes > self.max_bytes
+        if over_cap:
+            self.evict()
+
+    def files(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.jpg'):
+                    path = os.path.join(directory, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def evict(self):
+        # Shrink to 90% of the cap, so eviction does not run again on the next few writes
+        files = sorted(self.files(), key=lambda item: item[1].st_mtime)
+        total = sum(stat.st_size for _, stat in files)
+        target = self.max_bytes * 0.9
+        for path, stat in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= stat.st_size
+        with self.lock:
+            self.total_bytes = total
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_thumbnail_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ThumbnailCache(settings.THUMBNAIL_CACHE_ROOT, settings.THUMBNAIL_CACHE_MAX_BYTES,
+                                        settings.THUMBNAIL_WORKERS)
+    return _cache
+
+
+def read_image_size(file):
+    """Returns the displayed (width, height) of an image file from its header, or None for other files."""
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+            if image.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+    finally:
+        file.seek(0)
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework import routers
 
-from . import api
+from . import api, views
 
 
 router = routers.DefaultRouter(trailing_slash=False)
@@ -15,4 +15,8 @@ urlpatterns = [
     path('accounts/google/login/callback/', api.google_login_callback, name='google_login_callback'),
     path('api/', include(router.urls)),
     path('api/logout', api.logout_view, name='logout'),
+    path('api/token', api.token_obtain_view, name='token_obtain'),
+    path('api/token/refresh', api.token_refresh_view, name='token_refresh'),
+    path('api/ws_ticket', api.ws_ticket_view, name='ws_ticket'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
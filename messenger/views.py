@@ -0,0 +1,23 @@
+import secrets
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+
+from . import metrics
+
+
+def has_metrics_access(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if token and scheme.lower() == 'bearer' and secrets.compare_digest(credentials.encode(), token.encode()):
+        return True
+    return request.user.is_active and request.user.is_staff
+
+
+def metrics_view(request):
+    if not getattr(settings, 'METRICS_ENABLED', True):
+        raise Http404()
+    if not has_metrics_access(request):
+        raise PermissionDenied()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import msgpack
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+
+from .serializers import message_timestamp_format
+
+
+MSGPACK_MEDIA_TYPE = 'application/vnd.msgpack'
+# Offered by WebSocket clients in Sec-WebSocket-Protocol to get binary msgpack frames
+MSGPACK_SUBPROTOCOL = 'msgpack'
+
+TIMESTAMP_KEYS = ('timestamp', 'last_activity')
+# Side table of the users referenced by the messages of a page or a snapshot
+USERS_KEY = 'users_by_id'
+
+
+def parse_timestamp(value):
+    # Message timestamps put the day before the month, so they are tried before ISO 8601
+    try:
+        moment = datetime.strptime(value, message_timestamp_format)
+    except ValueError:
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return msgpack.Timestamp.from_datetime(moment)
+
+
+def compact(data):
+    """Rewrites serialized data for the msgpack wire format.
+
+    Timestamps become msgpack timestamps instead of strings, and the messages nested in a page or a snapshot refer to
+    their author by id, with every author listed once under `users_by_id`. A lone message keeps its user inline.
+    """
+    users = {}
+    hoist_users = isinstance(data, dict)
+
+    def walk(value, depth):
+        if isinstance(value, list):
+            return [walk(item, depth + 1) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        value = {key: walk(item, depth + 1) for key, item in value.items()}
+        for key in TIMESTAMP_KEYS:
+            if isinstance(value.get(key), str):
+                value[key] = parse_timestamp(value[key])
+        user = value.get('user')
+        if hoist_users and depth > 1 and 'number' in value and isinstance(user, dict) and 'id' in user:
+            users.setdefault(user['id'], user)
+            value['user'] = user['id']
+        return value
+
+    data = walk(data, 0)
+    if users:
+        data[USERS_KEY] = users
+    return data
+
+
+def pack(data):
+    return msgpack.packb(compact(data), use_bin_type=True)
+
+
+def unpack(content):
+    return msgpack.unpackb(content, raw=False, strict_map_key=False, timestamp=3)
+
+
+class MsgPackRenderer(BaseRenderer):
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return pack(data)
+
+
+class MsgPackParser(BaseParser):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return unpack(stream.read())
+        except (ValueError, msgpack.UnpackException) as error:
+            raise ParseError(f'msgpack parse error - {error}')
+
+
+def enable_permessage_deflate():
+    """Makes Daphne accept permessage-deflate, which it supports through Autobahn but never offers to enable."""
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+    from daphne.ws_protocol import WebSocketFactory
+
+    if getattr(WebSocketFactory, 'permessage_deflate', False):
+        return
+
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(offer)
+        return None
+
+    original_init = WebSocketFactory.__init__
+
+    def __init__(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self.setProtocolOptions(perMessageCompressionAccept=accept)
+
+    WebSocketFactory.__init__ = __init__
+    WebSocketFactory.permessage_deflate = True
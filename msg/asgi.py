@@ -10,22 +10,24 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.security.websocket import AllowedHostsOriginValidator
-
-from messenger import routing
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'msg.settings')
 
+# Apps must be loaded before the consumers (and their models) are imported, e.g. when served by `daphne`.
 django_asgi_app = get_asgi_application()
 
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+
+from messenger import routing
+from messenger.middleware import TicketAuthMiddleware
+
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        TicketAuthMiddleware(
             URLRouter(
                 routing.websocket_urlpatterns
             )